@@ -0,0 +1,359 @@
+"""
+Offline per-stage benchmark of the smear analysis pipeline.
+
+Runs every stage of detection, extraction, classification and explainability on a
+synthetic blood smear with randomly initialised weights, so it needs neither a
+Frappe site, a database nor the trained checkpoints. Frappe is replaced by a small
+in-memory stand-in that keeps inserted rows in SQLite and files in a temp folder.
+
+Randomly initialised weights do not find real cells, so every stage after inference
+is fed the synthetic ground-truth boxes; the inference stage still runs the real
+Faster R-CNN graph at the real input size.
+
+    python benchmarks/pipeline_benchmark.py --width 3000 --height 2000 --density 120
+    python benchmarks/pipeline_benchmark.py --repeat 3 --json > baseline.json
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STAGES = ("decode", "resize", "inference", "area_filter", "crop", "classification", "gradcam", "encode", "persist")
+
+
+class _dict(dict):
+    __getattr__ = dict.get
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+
+class StubDatabase:
+    """The parts of `frappe.db` the pipeline uses, backed by an in-memory SQLite database."""
+    def __init__(self, config):
+        self.config = config
+        self.connection = sqlite3.connect(":memory:")
+        self.tables = set()
+
+    def _ensure_table(self, doctype, fields):
+        table = f"tab{doctype}"
+        if table not in self.tables:
+            self.connection.execute(f'CREATE TABLE "{table}" ({", ".join(f"`{field}`" for field in fields)})')
+            self.tables.add(table)
+        else:
+            existing = {row[1] for row in self.connection.execute(f'PRAGMA table_info("{table}")')}
+            for field in fields:
+                if field not in existing:
+                    self.connection.execute(f'ALTER TABLE "{table}" ADD COLUMN `{field}`')
+        return table
+
+    def bulk_insert(self, doctype, fields, values, chunk_size=10000, **kwargs):
+        table = self._ensure_table(doctype, fields)
+        placeholders = ", ".join("?" * len(fields))
+        columns = ", ".join(f"`{field}`" for field in fields)
+        values = [tuple(value if isinstance(value, (int, float, str, type(None))) else str(value) for value in row)
+                  for row in values]
+        for start in range(0, len(values), chunk_size):
+            self.connection.executemany(f'INSERT INTO "{table}" ({columns}) VALUES ({placeholders})',
+                                        values[start:start + chunk_size])
+
+    def bulk_update(self, doctype, doc_updates, chunk_size=100, **kwargs):
+        for name, updates in doc_updates.items():
+            table = self._ensure_table(doctype, ["name", *updates])
+            assignments = ", ".join(f"`{field}` = ?" for field in updates)
+            self.connection.execute(f'UPDATE "{table}" SET {assignments} WHERE name = ?', (*updates.values(), name))
+
+    def get_single_value(self, doctype, fieldname, *args, **kwargs):
+        return self.config.get(fieldname)
+
+    def get_value(self, *args, **kwargs):
+        return None
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+
+def install_frappe_stub(config, site_path):
+    """Register a minimal `frappe` package in sys.modules for importing medical_imaging.api."""
+    frappe = types.ModuleType("frappe")
+    frappe._dict = _dict
+    frappe.db = StubDatabase(config)
+    frappe.session = _dict(user="Administrator")
+    frappe.local = _dict(site="benchmark", sites_path=site_path)
+    frappe.whitelist = lambda *args, **kwargs: (args[0] if args and callable(args[0]) else (lambda fn: fn))
+    frappe.get_single = lambda doctype: _dict(config)
+    frappe.get_meta = lambda doctype: _dict(autoname="hash", fields=[])
+    frappe.get_site_path = lambda *parts: os.path.join(site_path, *parts)
+    frappe.generate_hash = lambda *args, length=10, **kwargs: uuid.uuid4().hex[:length]
+    frappe.logger = lambda *args, **kwargs: logging.getLogger("medical_imaging.benchmark")
+    frappe.log_error = lambda *args, **kwargs: logging.getLogger("medical_imaging.benchmark").error(args)
+    frappe.publish_realtime = frappe.msgprint = frappe.enqueue = frappe.only_for = lambda *args, **kwargs: None
+
+    def throw(message, *args, **kwargs):
+        raise Exception(message)
+    frappe.throw = throw
+
+    def get_doc(*args, **kwargs):
+        doc = _dict(args[0] if args and isinstance(args[0], dict) else kwargs)
+        doc.insert = lambda *a, **k: doc.update(name=frappe.generate_hash()) or doc
+        return doc
+    frappe.get_doc = get_doc
+
+    utils = types.ModuleType("frappe.utils")
+    utils.cint = lambda value, default=0: int(value or default)
+    utils.now_datetime = datetime.now
+    utils.now = lambda: str(datetime.now())
+    utils.add_to_date = lambda date, **kwargs: date
+    utils.get_bench_path = lambda: site_path
+    file_manager = types.ModuleType("frappe.utils.file_manager")
+    file_manager.get_file_path = lambda file_url: os.path.join(site_path, file_url.lstrip("/"))
+    model = types.ModuleType("frappe.model")
+    naming = types.ModuleType("frappe.model.naming")
+    naming.parse_naming_series = lambda *args, **kwargs: frappe.generate_hash()
+    document = types.ModuleType("frappe.model.document")
+    document.Document = type("Document", (), {})
+
+    frappe.utils, utils.file_manager, frappe.model, model.naming, model.document = utils, file_manager, model, naming, document
+    for module in (frappe, utils, file_manager, model, naming, document):
+        sys.modules[module.__name__] = module
+    return frappe
+
+
+class PeakRSS:
+    """Sample this process's resident set size in a background thread to find per-stage peaks."""
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self.peak = 0
+        self.running = False
+
+    def current(self):
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * self.page_size
+        except OSError:
+            # No procfs (e.g. macOS): fall back to the lifetime peak, in kB on Linux and bytes on macOS
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == "darwin" else peak * 1024
+
+    def _sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.current())
+            time.sleep(self.interval)
+
+    @contextmanager
+    def measure(self):
+        self.peak = self.current()
+        self.running = True
+        sampler = threading.Thread(target=self._sample, daemon=True)
+        sampler.start()
+        try:
+            yield self
+        finally:
+            self.running = False
+            sampler.join()
+            self.peak = max(self.peak, self.current())
+
+
+def make_synthetic_smear(width, height, density, seed=0):
+    """
+    Draw a pale background with `density` elliptical cells per megapixel, a mix of round
+    and elongated shapes of 40-70 px like real RBCs at the scanner's magnification.
+    :return: (PIL image, Nx4 float32 ground-truth boxes, N int64 labels).
+    """
+    rng = np.random.default_rng(seed)
+    img = Image.new("RGB", (width, height), (236, 214, 214))
+    draw = ImageDraw.Draw(img)
+
+    count = max(1, int(density * width * height / 1e6))
+    boxes, labels = [], []
+    for _ in range(count):
+        label = int(rng.choice([1, 2, 3], p=[0.7, 0.2, 0.1]))
+        w = rng.uniform(40, 70)
+        h = w * (rng.uniform(0.45, 0.7) if label == 2 else rng.uniform(0.85, 1.0))
+        x1, y1 = rng.uniform(0, width - w), rng.uniform(0, height - h)
+        fill = tuple(int(c) for c in rng.integers([190, 90, 100], [225, 130, 140]))
+        draw.ellipse([x1, y1, x1 + w, y1 + h], fill=fill, outline=(150, 60, 70), width=2)
+        boxes.append([x1, y1, x1 + w, y1 + h])
+        labels.append(label)
+
+    return img, np.array(boxes, dtype=np.float32), np.array(labels, dtype=np.int64)
+
+
+def save_random_weights(folder):
+    """Save randomly initialised detector and classifier checkpoints of the production shapes."""
+    import torch
+    import torchvision
+    from torchvision.models.detection import fasterrcnn_resnet50_fpn
+    from medical_imaging.api.classification import EfficientNetB4, num_classes
+
+    detector = fasterrcnn_resnet50_fpn(weights=None, weights_backbone=None, progress=False)
+    detector.roi_heads.box_predictor = torchvision.models.detection.faster_rcnn.FastRCNNPredictor(
+        detector.roi_heads.box_predictor.cls_score.in_features, 4)
+    detector_path = os.path.join(folder, "fasterrcnn.pth")
+    torch.save(detector.state_dict(), detector_path)
+
+    classifier_path = os.path.join(folder, "efficientnet_b4.pth")
+    torch.save(EfficientNetB4(num_classes).state_dict(), classifier_path)
+    return detector_path, classifier_path
+
+
+def run_once(args, smear_bytes, gt_boxes, gt_labels, rss):
+    import torch
+    import torchvision.transforms as T
+    from medical_imaging.api.artifacts import encode_array
+    from medical_imaging.api.cell_detection import filter_by_area, get_detector
+    from medical_imaging.api.cell_extraction import crop_cell
+    from medical_imaging.api.classification import get_classifier, transform
+    from medical_imaging.api.explainability import GradCAM
+    from medical_imaging.api.persistence import bulk_insert
+
+    results = {}
+
+    @contextmanager
+    def stage(name, items):
+        with rss.measure():
+            start = time.perf_counter()
+            yield
+            elapsed = time.perf_counter() - start
+        results[name] = {"seconds": elapsed, "peak_rss_mb": rss.peak / 2**20, "items": items,
+                         "items_per_second": items / elapsed if elapsed else None}
+
+    with stage("decode", 1):
+        with Image.open(BytesIO(smear_bytes)) as smear:
+            img = smear.convert("RGB")
+        image = np.asarray(img)
+
+    with stage("resize", 1):
+        img_tensor = T.Compose([T.Resize((2000, 2000)), T.ToTensor()])(img)
+
+    detector = get_detector()
+    with stage("inference", 1):
+        with torch.no_grad():
+            detector([img_tensor])
+
+    with stage("area_filter", len(gt_boxes)):
+        boxes, labels, _ = filter_by_area(gt_boxes, gt_labels, np.ones(len(gt_boxes), dtype=np.float32),
+                                          args.area_tolerance / 100)
+
+    crops = []
+    with stage("crop", len(boxes)):
+        for x1, y1, x2, y2 in boxes.astype(int).tolist():
+            crop, left, top = crop_cell(image, x1, y1, x2, y2)
+            crops.append((crop, [x1 - left, y1 - top, x2 - left, y2 - top]))
+
+    classifier = get_classifier()
+    with stage("classification", len(crops)):
+        with torch.inference_mode():
+            for start in range(0, len(crops), args.batch_size):
+                batch = torch.stack([transform(Image.fromarray(crop)) for crop, _ in crops[start:start + args.batch_size]])
+                classifier(batch).argmax(dim=1)
+
+    xai_cells = crops[:args.xai_cells]
+    explainer = get_classifier(optimized=False)
+    with stage("gradcam", len(xai_cells)):
+        with GradCAM(explainer, explainer.efficientnet_b4.conv_head) as gradcam:
+            for start in range(0, len(xai_cells), args.batch_size):
+                gradcam(torch.stack([transform(Image.fromarray(crop)) for crop, _ in xai_cells[start:start + args.batch_size]]))
+
+    # Crops are packed into one atlas per detection image; outlines are drawn when a crop is served
+    # and the detection overlay in the browser, so neither is encoded here
+    with stage("encode", len(crops)):
+        atlas = encode_array(np.stack([crop for crop, _ in crops])) if crops else b""
+
+    with stage("persist", len(crops)):
+        folder = sys.modules["frappe"].get_site_path("private", "files")
+        with open(os.path.join(folder, "bench_cells.npy"), "wb") as f:
+            f.write(atlas)
+        bulk_insert("Extracted Cell", [
+            {"cell_detection_image": "BENCH", "cell_atlas": "/private/files/bench_cells.npy", "atlas_slot": slot,
+             "crop_box": json.dumps(crop_box), "primary_classification": str(label), "cell_number": slot + 1}
+            for slot, ((_, crop_box), label) in enumerate(zip(crops, labels.tolist()))
+        ])
+        sys.modules["frappe"].db.commit()
+
+    return results
+
+
+def summarise(runs):
+    """Median seconds and throughput, and the maximum peak RSS, of every stage over all runs."""
+    summary = {}
+    for name in STAGES:
+        samples = [run[name] for run in runs]
+        seconds = float(np.median([sample["seconds"] for sample in samples]))
+        items = samples[0]["items"]
+        summary[name] = {
+            "seconds": round(seconds, 4),
+            "peak_rss_mb": round(max(sample["peak_rss_mb"] for sample in samples), 1),
+            "items": items,
+            "items_per_second": round(items / seconds, 2) if seconds else None
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--width", type=int, default=3000, help="smear width in pixels")
+    parser.add_argument("--height", type=int, default=2000, help="smear height in pixels")
+    parser.add_argument("--density", type=float, default=120, help="cells per megapixel")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs after one warm-up run")
+    parser.add_argument("--batch-size", type=int, default=32, help="classification / Grad-CAM batch size")
+    parser.add_argument("--xai-cells", type=int, default=64, help="cells to run Grad-CAM on")
+    parser.add_argument("--area-tolerance", type=float, default=15, help="area tolerance in percent")
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads (0 keeps the default)")
+    parser.add_argument("--optimized", action="store_true", help="benchmark the optimized (frozen, int8 Linear layers) CPU model variants")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="medical_imaging_benchmark_")
+    for folder in ("private/files", "public/files"):
+        os.makedirs(os.path.join(workdir, folder))
+
+    config = {"use_model_server": 0, "optimized_inference": int(args.optimized), "torch_num_threads": args.threads,
+              "classification_batch_size": args.batch_size, "detection_average_area_tolerance": args.area_tolerance}
+    install_frappe_stub(config, workdir)
+    config["fasterrcnn_model_path"], config["classification_model_path"] = save_random_weights(workdir)
+
+    img, gt_boxes, gt_labels = make_synthetic_smear(args.width, args.height, args.density, args.seed)
+    buffered = BytesIO()
+    img.save(buffered, format="PNG")
+
+    rss = PeakRSS()
+    # The first run loads the models and warms allocator caches, so it is not reported
+    runs = [run_once(args, buffered.getvalue(), gt_boxes, gt_labels, rss) for _ in range(args.repeat + 1)][1:]
+    summary = summarise(runs)
+
+    if args.json:
+        print(json.dumps({"parameters": vars(args), "cells": len(gt_boxes), "stages": summary}, indent=1))
+        return
+
+    print(f"{args.width}x{args.height} smear, {len(gt_boxes)} cells, median of {args.repeat} runs")
+    print(f"{'stage':<16}{'seconds':>10}{'peak RSS MB':>14}{'items':>8}{'items/s':>12}")
+    for name, result in summary.items():
+        print(f"{name:<16}{result['seconds']:>10.4f}{result['peak_rss_mb']:>14.1f}"
+              f"{result['items']:>8}{result['items_per_second'] or 0:>12.2f}")
+    print(f"{'total':<16}{sum(result['seconds'] for result in summary.values()):>10.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+from collections import Counter
+
+import frappe
+from frappe.utils import now
+
+AGGREGATE_DOCTYPE = "Cell Classification Count"
+UNCLASSIFIED = "Select"
+
+
+def get_aggregate_name(cell_detection_image, primary, validated):
+    return f"{cell_detection_image}:{primary}:{validated}"
+
+def count_pairs(cell_detection_image):
+    """
+    Cells of one Cell Detection Image per (primary, validated) classification pair,
+    counted by the database with a single grouped query.
+    """
+    from frappe.query_builder.functions import Count
+
+    cell = frappe.qb.DocType("Extracted Cell")
+    rows = (
+        frappe.qb.from_(cell)
+        .select(cell.primary_classification, cell.validated_classification, Count("*"))
+        .where(cell.cell_detection_image == cell_detection_image)
+        .groupby(cell.primary_classification, cell.validated_classification)
+    ).run()
+    return {(primary or UNCLASSIFIED, validated or UNCLASSIFIED): count for primary, validated, count in rows}
+
+def apply_deltas(cell_detection_image, deltas):
+    """
+    Add `deltas` ({(primary, validated): change}) to the stored pair counts. Each pair is one
+    atomic upsert, so concurrent workers never lose an update.
+    """
+    if not cell_detection_image:
+        return
+
+    timestamp = now()
+    user = frappe.session.user
+    for (primary, validated), delta in deltas.items():
+        if not delta:
+            continue
+        frappe.db.sql("""
+            INSERT INTO `tabCell Classification Count`
+                (`name`, `creation`, `modified`, `owner`, `modified_by`, `docstatus`,
+                 `cell_detection_image`, `primary_classification`, `validated_classification`, `cell_count`)
+            VALUES (%(name)s, %(now)s, %(now)s, %(user)s, %(user)s, 0, %(image)s, %(primary)s, %(validated)s, %(delta)s)
+            ON DUPLICATE KEY UPDATE `cell_count` = `cell_count` + %(delta)s, `modified` = %(now)s
+        """, {
+            "name": get_aggregate_name(cell_detection_image, primary, validated),
+            "now": timestamp,
+            "user": user,
+            "image": cell_detection_image,
+            "primary": primary,
+            "validated": validated,
+            "delta": delta
+        })
+
+def record_cells(cell_detection_image, cells, sign=1):
+    """Count inserted cells (or, with `sign=-1`, deleted ones) given as dicts with both classifications."""
+    apply_deltas(cell_detection_image, Counter({
+        pair: sign * count
+        for pair, count in Counter(
+            (cell.get("primary_classification") or UNCLASSIFIED, cell.get("validated_classification") or UNCLASSIFIED)
+            for cell in cells
+        ).items()
+    }))
+
+def record_reclassification(cell_detection_image, changes):
+    """
+    Move cells between pairs after a reclassification.
+    :param changes: iterable of (old primary, old validated, new primary, new validated).
+    """
+    deltas = Counter()
+    for old_primary, old_validated, new_primary, new_validated in changes:
+        old = (old_primary or UNCLASSIFIED, old_validated or UNCLASSIFIED)
+        new = (new_primary or UNCLASSIFIED, new_validated or UNCLASSIFIED)
+        if old != new:
+            deltas[old] -= 1
+            deltas[new] += 1
+    apply_deltas(cell_detection_image, deltas)
+
+def rebuild(cell_detection_image):
+    """Recompute the stored pair counts of one Cell Detection Image from its Extracted Cells."""
+    frappe.db.delete(AGGREGATE_DOCTYPE, {"cell_detection_image": cell_detection_image})
+    apply_deltas(cell_detection_image, count_pairs(cell_detection_image))
+
+def get_pair_counts(cell_detection_image):
+    """
+    Stored pair counts of a Cell Detection Image. Images extracted before the counts were
+    maintained are backfilled on first use (and by the `rebuild_cell_classification_counts` patch).
+    """
+    rows = frappe.get_all(AGGREGATE_DOCTYPE,
+                          filters={"cell_detection_image": cell_detection_image},
+                          fields=["primary_classification", "validated_classification", "cell_count"])
+    if not rows and frappe.db.exists("Extracted Cell", {"cell_detection_image": cell_detection_image}):
+        rebuild(cell_detection_image)
+        return count_pairs(cell_detection_image)
+
+    return {(row.primary_classification, row.validated_classification): row.cell_count for row in rows if row.cell_count > 0}
+
+def get_class_counts(cell_detection_image, source="Final"):
+    """
+    Cells per class of a Cell Detection Image.
+    :param source: "Primary" (detector label), "Validated" (classifier or reviewer label), or
+        "Final", the validated label where one is set and the primary label otherwise.
+    """
+    counts = Counter()
+    for (primary, validated), count in get_pair_counts(cell_detection_image).items():
+        if source == "Primary":
+            classification = primary
+        elif source == "Validated":
+            classification = validated
+        else:
+            classification = validated if validated != UNCLASSIFIED else primary
+        counts[classification] += count
+    return counts
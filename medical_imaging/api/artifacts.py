@@ -0,0 +1,87 @@
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+import frappe
+from frappe.utils.file_manager import get_file_path
+from medical_imaging.api import metrics
+
+
+def encode_image(img, format="PNG", **params):
+    """
+    Encode a PIL image or HxWx3 uint8 array straight into bytes.
+    :return: encoded image bytes.
+    """
+    with metrics.span("artifact_encode"):
+        if isinstance(img, np.ndarray):
+            img = Image.fromarray(img)
+
+        buffered = BytesIO()
+        img.save(buffered, format=format, **params)
+        return buffered.getvalue()
+
+def save_image(img, file_name, format="PNG", is_private=True, **attached_to):
+    """
+    Store an image through the file manager without touching a temp file or base64.
+    :param attached_to: optional attached_to_doctype / attached_to_name / attached_to_field.
+    :return: the inserted File document.
+    """
+    file_doc = frappe.get_doc({
+        "doctype": "File",
+        "file_name": file_name,
+        "content": encode_image(img, format),
+        "is_private": is_private,
+        **attached_to
+    })
+    with metrics.span("db_write"):
+        file_doc.insert(ignore_permissions=True)
+    return file_doc
+
+def save_arrays(arrays, file_name, is_private=True, **attached_to):
+    """
+    Store named numpy arrays as one compressed .npz File.
+    :param arrays: dict of array name -> array.
+    :return: the inserted File document.
+    """
+    with metrics.span("artifact_encode"):
+        buffered = BytesIO()
+        np.savez_compressed(buffered, **arrays)
+
+    file_doc = frappe.get_doc({
+        "doctype": "File",
+        "file_name": file_name,
+        "content": buffered.getvalue(),
+        "is_private": is_private,
+        **attached_to
+    })
+    with metrics.span("db_write"):
+        file_doc.insert(ignore_permissions=True)
+    return file_doc
+
+def encode_array(array):
+    """Serialise one numpy array as uncompressed .npy bytes, which can be memory-mapped when read back."""
+    with metrics.span("artifact_encode"):
+        buffered = BytesIO()
+        np.save(buffered, array)
+        return buffered.getvalue()
+
+def save_array(array, file_name, is_private=True, **attached_to):
+    """
+    Store one numpy array as an uncompressed .npy File, so readers can slice it without loading it.
+    :return: the inserted File document.
+    """
+    file_doc = frappe.get_doc({
+        "doctype": "File",
+        "file_name": file_name,
+        "content": encode_array(array),
+        "is_private": is_private,
+        **attached_to
+    })
+    with metrics.span("db_write"):
+        file_doc.insert(ignore_permissions=True)
+    return file_doc
+
+def load_arrays(file_url):
+    """Read back every array of a .npz File saved by `save_arrays`, as a dict."""
+    with np.load(get_file_path(file_url), allow_pickle=False) as arrays:
+        return {name: arrays[name] for name in arrays.files}
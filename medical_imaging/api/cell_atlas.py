@@ -0,0 +1,85 @@
+import json
+import os
+from functools import lru_cache
+from urllib.parse import urlencode
+
+import numpy as np
+from PIL import Image
+import frappe
+from frappe.utils import cint
+from frappe.utils.file_manager import get_file_path
+from medical_imaging.api.artifacts import encode_image, save_array
+
+CELL_IMAGE_METHOD = "/api/method/medical_imaging.api.cell_atlas.get_cell_image"
+
+
+def save_atlas(cell_detection_image_id, crops):
+    """
+    Pack the crops of one extraction into a single N x size x size x 3 atlas, stored as one
+    .npy File attached to the Cell Detection Image. Slot `i` holds crop `i`.
+    :return: the atlas File document.
+    """
+    return save_array(np.stack(crops), f"{cell_detection_image_id}_cells.npy",
+                      attached_to_doctype="Cell Detection Image", attached_to_name=cell_detection_image_id)
+
+def get_cell_image_url(extracted_cell, outline=False):
+    """URL serving the crop of an Extracted Cell from its atlas, with its bounding box drawn when `outline`."""
+    args = {"extracted_cell": extracted_cell}
+    if outline:
+        args["outline"] = 1
+    return f"{CELL_IMAGE_METHOD}?{urlencode(args)}"
+
+@lru_cache(maxsize=32)
+def open_atlas(path):
+    # Memory-mapped: a slot read touches only that crop's pages, not the whole atlas
+    return np.load(path, mmap_mode="r", allow_pickle=False)
+
+def get_cell_source(cell):
+    """
+    Where the crop of an Extracted Cell is stored: (atlas path, slot) for atlas cells and
+    (image path, None) for cells extracted before atlases; (None, None) when missing.
+    :param cell: dict or document with `cell_image`, `cell_atlas` and `atlas_slot`.
+    """
+    if cell.get("cell_atlas"):
+        path = get_file_path(cell.cell_atlas)
+        return (path, cint(cell.atlas_slot)) if os.path.exists(path) else (None, None)
+
+    path = get_file_path(cell.cell_image) if cell.get("cell_image") else None
+    return (path, None) if path and os.path.exists(path) else (None, None)
+
+def open_cell_source(path, slot):
+    """RGB PIL image of a crop from `get_cell_source`. Needs no frappe context, so pool workers can use it."""
+    if slot is not None:
+        return Image.fromarray(np.array(open_atlas(path)[slot]))
+    with Image.open(path) as img:
+        return img.convert("RGB")
+
+def load_cell_image(cell):
+    """Crop of an Extracted Cell as an RGB PIL image, or None when its atlas or file is missing."""
+    path, slot = get_cell_source(cell)
+    return open_cell_source(path, slot) if path else None
+
+@frappe.whitelist()
+def get_cell_image(extracted_cell, outline=0):
+    """
+    API serving the crop of an Extracted Cell as a PNG, sliced out of its detection image's atlas.
+    With `outline`, the cell's bounding box is drawn in, as the former `_CD` files had it.
+    """
+    from werkzeug.wrappers import Response
+
+    cell = frappe.get_doc("Extracted Cell", extracted_cell)
+    cell.check_permission("read")
+
+    img = load_cell_image(cell)
+    if img is None:
+        return Response(status=404)
+
+    if cint(outline) and cell.crop_box:
+        from medical_imaging.api.cell_extraction import draw_cell_outline
+
+        x1, y1, x2, y2 = json.loads(cell.crop_box)
+        img = draw_cell_outline(np.asarray(img), x1, y1, x2, y2, 0, 0)
+
+    # An extracted crop never changes, so browsers may keep it
+    return Response(encode_image(img), content_type="image/png",
+                    headers={"Cache-Control": "private, max-age=86400"})
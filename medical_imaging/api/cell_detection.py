@@ -1,26 +1,23 @@
-import base64
-import json
-import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 import torchvision
 import torchvision.transforms as T
-from PIL import Image, ImageDraw
+from PIL import Image
 from torchvision.models.detection import fasterrcnn_resnet50_fpn
 import frappe
 from frappe.utils.file_manager import get_file_path
-from medical_imaging.doctype.blood_cell_analysis_configuration.blood_cell_analysis_configuration import ( get_detection_threshold_configuration, get_detection_average_area_tolerance)
+from medical_imaging.doctype.blood_cell_analysis_configuration.blood_cell_analysis_configuration import ( get_batch_detection_configuration, get_detection_threshold_configuration, get_detection_average_area_tolerance, get_detection_tiling_configuration, get_inference_configuration)
+from medical_imaging.api import detection_cache, metrics, model_registry, model_server, optimization
+from medical_imaging.api.detections import read_detections, save_detections
 
-configurations = frappe.get_single("Blood Cell Analysis Configuration")
-# Load Faster R-CNN model
-model_path = configurations.fasterrcnn_model_path
 
-def get_predictions(image_path):
+def build_detector(model_path):
     device = torch.device("cpu")
 
     # Load Faster R-CNN model
-    model = fasterrcnn_resnet50_fpn(weights=None, progress=False)
+    model = fasterrcnn_resnet50_fpn(weights=None, weights_backbone=None, progress=False)
 
     # Get the number of input features for the classifier
     in_features = model.roi_heads.box_predictor.cls_score.in_features
@@ -33,17 +30,68 @@ def get_predictions(image_path):
     # Set the model to evaluation mode
     model.eval()
     model.to(device)
+    return model
 
-    # Load and preprocess the image
-    img = Image.open(image_path).convert("RGB")  # Load image and convert to RGB
-    original_width, original_height = img.size
+def build_optimized_detector(model_path):
+    return optimization.optimize_detector(build_detector(model_path))
+
+def get_detector(optimized=None):
+    """
+    Faster R-CNN detector for this worker, loaded once and reused across requests.
+    :param optimized: use the int8 CPU variant; defaults to the Optimized Inference setting.
+    """
+    optimization.apply_thread_settings()
+    if optimized is None:
+        optimized = get_inference_configuration().optimized
+
+    model_path = frappe.db.get_single_value("Blood Cell Analysis Configuration", "fasterrcnn_model_path")
+    if optimized:
+        return model_registry.get_model("detector:optimized", model_path, build_optimized_detector)
+    return model_registry.get_model("detector", model_path, build_detector)
+
+def run_detector(images):
+    """
+    Faster R-CNN outputs for a list of CHW tensors, from the local model server when it is
+    enabled and from this worker's cached detector otherwise.
+    """
+    if model_server.is_enabled():
+        try:
+            with metrics.span("inference"):
+                return model_server.detect(images)
+        except OSError as e:
+            frappe.logger().warning(f"Model server unavailable, detecting in-process: {e}")
+
+    model = get_detector()
+    with metrics.span("inference"), torch.no_grad():
+        return model(images)
+
+def get_tile_origins(length, tile_size, overlap):
+    """Start offsets of tiles covering `length` pixels, the last tile flush with the edge."""
+    if length <= tile_size:
+        return [0]
+    stride = max(1, tile_size - overlap)
+    origins = list(range(0, length - tile_size, stride))
+    origins.append(length - tile_size)
+    return origins
+
+def get_resized_predictions(model, img, device):
+    return get_resized_predictions_batch(model, [img], device)[0]
+
+def get_resized_predictions_batch(model, imgs, device):
+    """Run the detector once over several smears, each resized to the 2000x2000 model input."""
     transforms = T.Compose([T.Resize((2000, 2000)), T.ToTensor()])
-    img_tensor = transforms(img).to(device)  # Apply transformations
+    with metrics.span("preprocess"):
+        img_tensors = [transforms(img).to(device) for img in imgs]  # Apply transformations
 
     # Perform inference (get predicted bounding boxes and scores)
     with torch.no_grad():
-        prediction = model([img_tensor])[0]
+        predictions = model(img_tensors)
+
+    return [scale_prediction(prediction, img.size) for img, prediction in zip(imgs, predictions)]
 
+def scale_prediction(prediction, original_size):
+    """Detector output on the 2000x2000 input as numpy arrays in original image coordinates."""
+    original_width, original_height = original_size
     pred_boxes = prediction['boxes'].cpu().numpy()
     pred_labels = prediction['labels'].cpu().numpy()
     scores = prediction['scores'].cpu().numpy()
@@ -58,17 +106,105 @@ def get_predictions(image_path):
     pred_boxes[:, 2] *= scale_x  # x2
     pred_boxes[:, 3] *= scale_y  # y2
 
+    return pred_boxes, pred_labels, scores
+
+def get_tiled_predictions(model, img, device, tile_size, overlap, batch_size, iou_threshold=0.5):
+    """
+    Run the detector over overlapping native-resolution tiles, `batch_size` tiles at a time,
+    and merge the per-tile detections in global image coordinates.
+    """
+    width, height = img.size
+    to_tensor = T.ToTensor()
+    tiles = [(x, y) for y in get_tile_origins(height, tile_size, overlap)
+             for x in get_tile_origins(width, tile_size, overlap)]
+
+    all_boxes, all_labels, all_scores = [], [], []
+    edge_margin = 2
+    for start in range(0, len(tiles), batch_size):
+        batch = tiles[start:start + batch_size]
+        with metrics.span("preprocess"):
+            tensors = [to_tensor(img.crop((x, y, min(x + tile_size, width), min(y + tile_size, height)))).to(device)
+                       for x, y in batch]
+
+        with torch.no_grad():
+            outputs = model(tensors)
+
+        for (x, y), tensor, output in zip(batch, tensors, outputs):
+            boxes = output['boxes']
+            tile_h, tile_w = tensor.shape[1:]
+
+            # Drop boxes clipped by a tile seam; the overlapping tile sees those cells whole
+            keep = torch.ones(len(boxes), dtype=torch.bool)
+            if x > 0:
+                keep &= boxes[:, 0] > edge_margin
+            if y > 0:
+                keep &= boxes[:, 1] > edge_margin
+            if x + tile_w < width:
+                keep &= boxes[:, 2] < tile_w - edge_margin
+            if y + tile_h < height:
+                keep &= boxes[:, 3] < tile_h - edge_margin
+
+            offset = torch.tensor([x, y, x, y], dtype=boxes.dtype, device=boxes.device)
+            all_boxes.append(boxes[keep] + offset)
+            all_labels.append(output['labels'][keep])
+            all_scores.append(output['scores'][keep])
+
+        del tensors, outputs
+
+    boxes = torch.cat(all_boxes)
+    labels = torch.cat(all_labels)
+    scores = torch.cat(all_scores)
+
+    # Class-agnostic NMS merges the same cell seen by neighbouring tiles
+    with metrics.span("post_processing"):
+        keep = torchvision.ops.nms(boxes, scores, iou_threshold)
+        keep = keep[torch.argsort(scores[keep], descending=True)]
+
+    return boxes[keep].cpu().numpy(), labels[keep].cpu().numpy(), scores[keep].cpu().numpy()
+
+def get_raw_predictions(image_path, img=None):
+    device = torch.device("cpu")
+    model = run_detector
+
+    # Load and preprocess the image, unless the caller already decoded it
+    if img is None:
+        with metrics.span("decode"):
+            img = Image.open(image_path).convert("RGB")  # Load image and convert to RGB
+
+    tiling = get_detection_tiling_configuration()
+    if tiling.mode == "Tiled":
+        return get_tiled_predictions(model, img, device, tiling.tile_size, tiling.overlap, max(1, tiling.batch_size))
+    return get_resized_predictions(model, img, device)
+
+def get_raw_predictions_batch(imgs):
+    """
+    Raw detector outputs for several decoded smears. Resized smears go through the detector
+    together in one call; tiled smears already batch their tiles and are detected one by one.
+    """
+    tiling = get_detection_tiling_configuration()
+    if tiling.mode == "Tiled":
+        return [get_raw_predictions(None, img=img) for img in imgs]
+    return get_resized_predictions_batch(run_detector, imgs, torch.device("cpu"))
+
+def get_cached_raw_predictions(image_path, img=None):
+    # Raw detector outputs are cached by smear content, so re-submissions skip inference entirely
+    return detection_cache.get_or_compute(image_path, lambda: get_raw_predictions(image_path, img=img))
+
+def filter_by_area(pred_boxes, pred_labels, scores, tolerance):
+    """Drop detections whose area exceeds the average detection area by more than `tolerance`."""
+    if not len(pred_boxes):
+        return pred_boxes, pred_labels, scores
+
     # Calculate the area of each detected item
     areas = (pred_boxes[:, 2] - pred_boxes[:, 0]) * (pred_boxes[:, 3] - pred_boxes[:, 1])
 
     # Compute the average area of all detected items
     average_area = np.mean(areas)
 
-    # Define the tolerance (15%)
-    tolerance = get_detection_average_area_tolerance()/100
+    # Define the upper limit from the tolerance (e.g. 15%)
     upper_limit = average_area * (1 + tolerance)
 
-    # Filter out items whose area exceeds the average area by more than 15%
+    # Filter out items whose area exceeds the average area by more than the tolerance
     valid_indices = areas <= upper_limit
     filtered_boxes = pred_boxes[valid_indices]
     filtered_labels = pred_labels[valid_indices]
@@ -76,55 +212,69 @@ def get_predictions(image_path):
 
     return filtered_boxes, filtered_labels, filtered_scores
 
-def save_img_prediction(prediction, img_path, id, score_threshold):
-    pred_boxes, pred_labels, scores = prediction
-
-    class_names = ['background', 'circular', 'elongated', 'other']
-
-    # Filter predictions based on the score threshold
-    high_conf_boxes = pred_boxes[scores >= score_threshold]
-    high_conf_labels = pred_labels[scores >= score_threshold]
+def get_filter_settings():
+    """Score threshold and area tolerance currently configured, as fractions."""
+    return get_detection_threshold_configuration()/100, get_detection_average_area_tolerance()/100
 
-    # Load the image using PIL
-    img = Image.open(img_path).convert("RGB")
-
-    # Create a drawing context
-    draw = ImageDraw.Draw(img)
-
-    # Draw bounding boxes on the image
-    for box, label in zip(high_conf_boxes, high_conf_labels):
-        x1, y1, x2, y2 = box
-        color = "red"  # You can customize the color based on the label
-        draw.rectangle([x1, y1, x2, y2], outline=color, width=2)
+def filter_predictions(raw_prediction, score_threshold, tolerance):
+    """
+    Apply the area-tolerance rule over all raw detections, then the score threshold.
+    :return: (boxes, labels, scores) of the kept detections.
+    """
+    with metrics.span("post_processing"):
+        pred_boxes, pred_labels, scores = filter_by_area(*raw_prediction, tolerance)
 
+        # Filter predictions based on the score threshold
+        keep = scores >= score_threshold
+        return pred_boxes[keep], pred_labels[keep], scores[keep]
 
-    # Save the image with bounding boxes
-    image_path = f'bloodcell.classify/private/files/{id}cell_detection_image.png'
+def run_detection(blood_smear_id, img=None):
+    """
+    Detect cells on a Blood Smear Image and store them as a Cell Detection Image. The kept
+    detections and the unfiltered detector output are stored as packed arrays; Detection
+    Result rows are only built when the form is first viewed, and the overlay is drawn from
+    the arrays by `medical_imaging.api.overlay`.
+    :param img: optional already decoded RGB PIL image of the smear.
+    :return: (Cell Detection Image doc, boxes, labels, scores) of the kept detections.
+    """
+    with metrics.record_run("Detection", blood_smear_id):
+        blood_smear_image = frappe.get_doc("Blood Smear Image", blood_smear_id)
 
-    # Save the image
-    img.save(image_path)
+        # The smear is only decoded when the detector actually has to run
+        full_path = get_file_path(blood_smear_image.image)
+        raw_prediction = get_cached_raw_predictions(full_path, img=img)
+        cell_detection_image, boxes, labels, scores = save_detection(blood_smear_id, raw_prediction)
 
-    # Encode the image in base64
-    with open(image_path, "rb") as img_file:
-        encoded_image = base64.b64encode(img_file.read()).decode("utf-8")
+    return cell_detection_image, boxes.tolist(), labels.tolist(), scores.tolist()
 
-    # Create a File document in Frappe
-    file_doc = frappe.get_doc({
-        "doctype": "File",
-        "file_name": f"cell_detection_image.png",
-        "file_url": f"/private/files/cell_detection_image.png",  # Ensure correct file path
-        "content": encoded_image,
-        "decode": True,
-        "is_private": True
+def save_detection(blood_smear_id, raw_prediction):
+    """
+    Filter the raw detector output of one smear and store it, with the packed detections,
+    as a committed Cell Detection Image.
+    :return: (Cell Detection Image doc, boxes, labels, scores) of the kept detections.
+    """
+    score_threshold, tolerance = get_filter_settings()
+    boxes, labels, scores = filter_predictions(raw_prediction, score_threshold, tolerance)
+    metrics.count_cells(len(boxes))
+
+    detections = save_detections((boxes, labels, scores), f"{blood_smear_id}_detections.npz")
+    raw_predictions = save_detections(raw_prediction, f"{blood_smear_id}_raw_predictions.npz")
+
+    # Store results in the Cell Detection Image doctype
+    cell_detection_image = frappe.get_doc({
+        "doctype": "Cell Detection Image",
+        "blood_smear_image": blood_smear_id,
+        "detections": detections.file_url,
+        "raw_predictions": raw_predictions.file_url,
+        "score_threshold": score_threshold * 100,
+        "area_tolerance": tolerance * 100
     })
+    with metrics.span("db_write"):
+        cell_detection_image.insert(ignore_permissions=True)
 
-    file_doc.insert(ignore_permissions=True)
-    frappe.db.commit()
-
-    if os.path.exists(image_path):
-        os.remove(image_path)
+        frappe.db.commit()
 
-    return high_conf_boxes, high_conf_labels, scores[scores >= score_threshold], file_doc.file_url
+    return cell_detection_image, boxes, labels, scores
 
 @frappe.whitelist(allow_guest=True)
 def detect_cells():
@@ -136,37 +286,8 @@ def detect_cells():
         if frappe.request.method != "POST":
             return {"message": "Invalid request method. Use POST.", "status": "failed"}
 
-        classes = ["Circular", "Elongated", "Other"]
         blood_smear_id = frappe.form_dict.get("blood_smear_id")
-        blood_smear_image = frappe.get_doc("Blood Smear Image", blood_smear_id)
-
-        full_path = get_file_path(blood_smear_image.image)
-        prediction = get_predictions(full_path)
-        score_threshold = get_detection_threshold_configuration()/100
-        prediction = save_img_prediction(prediction, full_path, blood_smear_id, score_threshold=score_threshold)
-
-        boxes, labels, scores, file_url = prediction
-        boxes = boxes.tolist()
-        labels = labels.tolist()
-        scores = scores.tolist()
-
-        # Store results in the Cell Detection Image doctype
-        cell_detection_image = frappe.get_doc({
-            "doctype": "Cell Detection Image",
-            "blood_smear_image": blood_smear_id,
-            "cell_detection_image": file_url,
-            "detection_result": []
-        })
-
-        for box, label, score in zip(boxes, labels, scores):
-            cell_detection_image.append("detection_result", {
-                "classification": classes[label-1],
-                "confidence_score": json.dumps(score),
-                "bounding_coordinates": json.dumps(box)
-            })
-
-        cell_detection_image.insert(ignore_permissions=True)
-        frappe.db.commit()
+        cell_detection_image, boxes, labels, scores = run_detection(blood_smear_id)
 
         print(cell_detection_image.name)
         return {
@@ -183,4 +304,200 @@ def detect_cells():
     except Exception as e:
         error_message = str(e)[:130]
         frappe.log_error(f"Error in cell detection: {error_message}")
-        return {"message": f"Error: {str(e)}", "status": "failed"}
\ No newline at end of file
+        return {"message": f"Error: {str(e)}", "status": "failed"}
+
+def decode_smear(image_path):
+    # Runs in decode threads: plain file and PIL work only, no frappe context needed
+    with Image.open(image_path) as img:
+        return img.convert("RGB")
+
+def publish_batch_detection_progress(user, done, total, result):
+    frappe.publish_realtime("batch_detection_progress", {
+        "done": done,
+        "total": total,
+        "result": result
+    }, user=user)
+
+def detect_blood_smear_images(blood_smear_ids, user=None, **kwargs):
+    """
+    Background job detecting cells on many Blood Smear Images. Smears are decoded by a thread
+    pool one batch ahead of the detector, so decoding overlaps inference; each batch goes
+    through the detector in one call and every smear is committed as soon as it is stored.
+    :return: one dict per smear with its Cell Detection Image, or the error that stopped it.
+    """
+    config = get_batch_detection_configuration()
+    batch_size = max(1, config.batch_size)
+    user = user or frappe.session.user
+
+    results = []
+    def finish(result):
+        results.append(result)
+        publish_batch_detection_progress(user, len(results), len(blood_smear_ids), result)
+
+    smears = []
+    for blood_smear_id in blood_smear_ids:
+        image = frappe.db.get_value("Blood Smear Image", blood_smear_id, "image")
+        if image:
+            smears.append((blood_smear_id, get_file_path(image)))
+        else:
+            finish({"blood_smear_image": blood_smear_id, "status": "failed", "message": "Blood Smear Image or its image not found."})
+
+    batches = [smears[start:start + batch_size] for start in range(0, len(smears), batch_size)]
+    with metrics.record_run("Batch Detection", None), \
+            ThreadPoolExecutor(max_workers=max(1, config.decode_workers)) as pool:
+        decoding = [pool.submit(decode_smear, path) for _, path in batches[0]] if batches else []
+        for i, batch in enumerate(batches):
+            futures = decoding
+            if i + 1 < len(batches):
+                # Start decoding the next batch while this one is detected and stored
+                decoding = [pool.submit(decode_smear, path) for _, path in batches[i + 1]]
+
+            decoded = []
+            with metrics.span("decode"):
+                for (blood_smear_id, path), future in zip(batch, futures):
+                    try:
+                        decoded.append((blood_smear_id, path, future.result()))
+                    except Exception as e:
+                        finish({"blood_smear_image": blood_smear_id, "status": "failed", "message": f"Decoding failed: {str(e)}"})
+            if not decoded:
+                continue
+
+            try:
+                raw_predictions = detection_cache.get_or_compute_many(
+                    [path for _, path, _ in decoded],
+                    lambda indices: get_raw_predictions_batch([decoded[j][2] for j in indices])
+                )
+            except Exception as e:
+                frappe.log_error(f"Batch Detection Error: {str(e)}", "Cell Detection")
+                for blood_smear_id, _, _ in decoded:
+                    finish({"blood_smear_image": blood_smear_id, "status": "failed", "message": str(e)[:140]})
+                continue
+
+            for (blood_smear_id, _, _), raw_prediction in zip(decoded, raw_predictions):
+                try:
+                    cell_detection_image, boxes, _, _ = save_detection(blood_smear_id, raw_prediction)
+                    finish({"blood_smear_image": blood_smear_id, "status": "success",
+                            "cell_detection_image": cell_detection_image.name, "detections": len(boxes)})
+                except Exception as e:
+                    frappe.db.rollback()
+                    frappe.log_error(f"Batch Detection Error for {blood_smear_id}: {str(e)}", "Cell Detection")
+                    finish({"blood_smear_image": blood_smear_id, "status": "failed", "message": str(e)[:140]})
+
+    succeeded = sum(result["status"] == "success" for result in results)
+    frappe.logger().info(f"Batch detection: {succeeded} of {len(blood_smear_ids)} Blood Smear Images detected")
+    return results
+
+@frappe.whitelist()
+def detect_cells_batch(blood_smear_ids):
+    """
+    API to detect cells on a list of Blood Smear Images in one background job. Progress is
+    published per smear as `batch_detection_progress`.
+    :return: JSON response with the queued status and the number of smears.
+    """
+    try:
+        blood_smear_ids = frappe.parse_json(blood_smear_ids)
+        if not blood_smear_ids:
+            return {"status": "error", "message": "No Blood Smear Images given."}
+        for blood_smear_id in blood_smear_ids:
+            frappe.get_doc("Blood Smear Image", blood_smear_id).check_permission("read")
+
+        frappe.enqueue("medical_imaging.api.cell_detection.detect_blood_smear_images",
+                       queue='long',
+                       job_name=f"Batch Detection of {len(blood_smear_ids)} Blood Smear Images",
+                       timeout=7200,
+                       enqueue_after_commit=True,
+                       blood_smear_ids=blood_smear_ids,
+                       user=frappe.session.user)
+        return {"status": "queued", "images": len(blood_smear_ids)}
+    except Exception as e:
+        frappe.log_error(f"Batch Detection Error: {str(e)}", "Cell Detection")
+        return {"status": "error", "message": str(e)}
+
+def refilter_detection(cell_detection_image_id):
+    """
+    Re-apply the configured score threshold and area tolerance to the stored raw predictions
+    of one Cell Detection Image, replacing its packed detections. Neither the detector nor
+    the smear image is touched.
+    :return: number of detections kept.
+    """
+    cell_detection_image = frappe.get_doc("Cell Detection Image", cell_detection_image_id)
+    if not cell_detection_image.raw_predictions:
+        frappe.throw(f"{cell_detection_image_id} has no stored raw predictions. Run detection again instead.")
+    if frappe.db.exists("Extracted Cell", {"cell_detection_image": cell_detection_image_id}):
+        frappe.throw(f"Cells of {cell_detection_image_id} are already extracted and would no longer match the detections.")
+
+    score_threshold, tolerance = get_filter_settings()
+    boxes, labels, scores = filter_predictions(read_detections(cell_detection_image.raw_predictions),
+                                               score_threshold, tolerance)
+
+    detections = save_detections((boxes, labels, scores), f"{cell_detection_image.blood_smear_image}_detections.npz")
+
+    for file_url in (cell_detection_image.cell_detection_image, cell_detection_image.detections):
+        old_file = frappe.db.get_value("File", {"file_url": file_url}, "name") if file_url else None
+        if old_file:
+            frappe.delete_doc("File", old_file, ignore_permissions=True)
+
+    # The document may be submitted, so derived fields are replaced directly and the
+    # Detection Result view is dropped, to be rebuilt from the new arrays on next view.
+    # A rasterized overlay from before vector overlays would no longer match, so it goes too.
+    frappe.db.delete("Detection Result", {"parent": cell_detection_image.name, "parenttype": "Cell Detection Image"})
+    frappe.db.set_value("Cell Detection Image", cell_detection_image.name, {
+        "cell_detection_image": None,
+        "detections": detections.file_url,
+        "score_threshold": score_threshold * 100,
+        "area_tolerance": tolerance * 100
+    })
+    return len(boxes)
+
+def refilter_detections_in_range(from_date, to_date, **kwargs):
+    """Background job re-filtering every Cell Detection Image created between two dates."""
+    cell_detection_images = frappe.get_all("Cell Detection Image",
+                                           filters={"creation": ["between", [from_date, to_date]],
+                                                    "raw_predictions": ["is", "set"]},
+                                           pluck="name",
+                                           order_by="creation asc")
+
+    refiltered, failed = 0, 0
+    for cell_detection_image_id in cell_detection_images:
+        try:
+            refilter_detection(cell_detection_image_id)
+            frappe.db.commit()
+            refiltered += 1
+        except Exception as e:
+            frappe.db.rollback()
+            failed += 1
+            frappe.log_error(f"Re-filter Error for {cell_detection_image_id}: {str(e)}", "Cell Detection")
+
+    frappe.logger().info(f"Re-filtered {refiltered} Cell Detection Images between {from_date} and {to_date}, {failed} failed")
+    return {"refiltered": refiltered, "failed": failed}
+
+@frappe.whitelist()
+def refilter_detections(cell_detection_image_id=None, from_date=None, to_date=None):
+    """
+    API to re-apply the current detection threshold and area tolerance to stored raw
+    predictions, for one Cell Detection Image or, in the background, for every one
+    created between `from_date` and `to_date`.
+    :return: JSON response with the number of kept detections, or the queued status.
+    """
+    try:
+        if cell_detection_image_id:
+            frappe.get_doc("Cell Detection Image", cell_detection_image_id).check_permission("write")
+            detections = refilter_detection(cell_detection_image_id)
+            frappe.db.commit()
+            return {"status": "success", "cell_detection_image": cell_detection_image_id, "detections": detections}
+
+        frappe.only_for("System Manager")
+        if not from_date or not to_date:
+            return {"status": "error", "message": "Pass either cell_detection_image_id or from_date and to_date."}
+
+        frappe.enqueue("medical_imaging.api.cell_detection.refilter_detections_in_range",
+                       queue='long',
+                       job_name=f"Re-filter Detections {from_date} to {to_date}",
+                       timeout=3600,
+                       enqueue_after_commit=True,
+                       from_date=from_date,
+                       to_date=to_date)
+        return {"status": "queued"}
+    except Exception as e:
+        frappe.log_error(f"Re-filter Error: {str(e)}", "Cell Detection")
+        return {"status": "error", "message": str(e)}
@@ -1,107 +1,121 @@
-import frappe
 import json
-import os
-import base64
+
+import frappe
+import numpy as np
 from PIL import Image, ImageDraw
 from frappe.utils.file_manager import get_file_path
+from medical_imaging.api import aggregates, metrics
+from medical_imaging.api.cell_atlas import get_cell_image_url, save_atlas
+from medical_imaging.api.detections import CLASSES, load_detections
+from medical_imaging.api.persistence import bulk_insert, reserve_names
 
+CELL_SIZE = 80
 
-@frappe.whitelist(allow_guest=True)
-def extract_cells():
+
+def crop_cell(image, x1, y1, x2, y2, size=CELL_SIZE):
     """
-    API to extract individual cell images from the original Blood Smear Image.
-    :return: JSON response with extracted cell details.
+    Slice the size x size square centred on a bounding box out of a decoded HxWx3 array.
+    The square is anchored at the image origin when it would start off-image and padded
+    with black past the right/bottom edge, matching what PIL's crop used to return.
+    :return: (crop array, left, top) of the square in image coordinates.
     """
-    try:
-        if frappe.request.method != "POST":
-            return {"message": "Invalid request method. Use POST.", "status": "failed"}
+    half_size = size // 2
+    new_x1 = max(0, (x1 + x2) // 2 - half_size)
+    new_y1 = max(0, (y1 + y2) // 2 - half_size)
+
+    crop = image[new_y1:new_y1 + size, new_x1:new_x1 + size]
+    if crop.shape[0] != size or crop.shape[1] != size:
+        padded = np.zeros((size, size, image.shape[2]), dtype=image.dtype)
+        padded[:crop.shape[0], :crop.shape[1]] = crop
+        crop = padded
+
+    return crop, new_x1, new_y1
+
+def draw_cell_outline(crop, x1, y1, x2, y2, left, top):
+    """Return a copy of one crop with its bounding box drawn in crop coordinates."""
+    crop_img = Image.fromarray(crop)
+    draw = ImageDraw.Draw(crop_img)
+    draw.rectangle([x1 - left, y1 - top, x2 - left, y2 - top], outline="red", width=2)
+    return crop_img
 
-        cell_detection_image_id = frappe.form_dict.get("cell_detection_image_id")
-        cell_detection_image_doc = frappe.get_doc("Cell Detection Image", cell_detection_image_id)
 
+def run_extraction(cell_detection_image_id, image=None):
+    """
+    Crop every detection of a Cell Detection Image into an Extracted Cell. All crops go into
+    one atlas File; each cell references its slot and is served by slicing the atlas.
+    :param image: optional already decoded HxWx3 array of the blood smear.
+    :return: list of extracted cell details.
+    """
+    # Detections are read from the packed arrays, so the Detection Result rows are never loaded
+    cell_detection_image_doc = frappe.db.get_value("Cell Detection Image", cell_detection_image_id,
+                                                   ["name", "blood_smear_image", "detections"], as_dict=True)
+
+    with metrics.record_run("Extraction", cell_detection_image_doc.blood_smear_image):
         # Fetch Blood Smear Image from linked Doctype
         blood_smear_doc = frappe.get_doc("Blood Smear Image", cell_detection_image_doc.blood_smear_image)
         blood_smear_image_path = get_file_path(blood_smear_doc.image)
 
-        extracted_cells = []
-        for result in cell_detection_image_doc.detection_result:
-            img = Image.open(blood_smear_image_path).convert("RGB")
-            bbox = json.loads(result.bounding_coordinates)
-            classification = result.classification
-
-            x1, y1, x2, y2 = map(int, bbox)
-
-            # Calculate the midpoint of the bounding box
-            mid_x = (x1 + x2) // 2
-            mid_y = (y1 + y2) // 2
-
-            # Define the 80x80 bounding square around the midpoint
-            half_size = 40  # Half of 80 pixels
-            new_x1 = max(0, mid_x - half_size)
-            new_y1 = max(0, mid_y - half_size)
-            new_x2 = new_x1 + 80
-            new_y2 = new_y1 + 80
-
-            cropped_img = img.crop((new_x1, new_y1, new_x2, new_y2))
-            extracted_path = f'bloodcell.classify/private/files/{cell_detection_image_id}_{new_x1}_{new_y1}.png'
-            cropped_img.save(extracted_path)
-
-            # Create a drawing context
-            draw = ImageDraw.Draw(img)
-
-            color = "red"  # You can customize the color based on the label
-            draw.rectangle([x1, y1, x2, y2], outline=color, width=2)
-
-            cropped_img_cd = img.crop((new_x1, new_y1, new_x2, new_y2))
-            extracted_path_cd = f'bloodcell.classify/private/files/{cell_detection_image_id}_{new_x1}_{new_y1}_CD.png'
-            cropped_img_cd.save(extracted_path_cd)
-
-            with open(extracted_path, "rb") as img_file:
-                encoded_image = base64.b64encode(img_file.read()).decode("utf-8")
-
-            with open(extracted_path_cd, "rb") as image_file_cd:
-                encoded_image_cd = base64.b64encode(image_file_cd.read()).decode("utf-8")
-
-            file_doc = frappe.get_doc({
-                "doctype": "File",
-                "file_name": f"{cell_detection_image_id}_{new_x1}_{new_y1}.png",
-                "file_url": f"/private/files/{cell_detection_image_id}_{new_x1}_{new_y1}.png",
-                "content": encoded_image,
-                "decode": True,
-                "is_private": True
-            })
-            file_doc.insert(ignore_permissions=True)
-
-            file_doc_cd = frappe.get_doc({
-                "doctype": "File",
-                "file_name": f"{cell_detection_image_id}_{new_x1}_{new_y1}_CD.png",
-                "file_url": f"/private/files/{cell_detection_image_id}_{new_x1}_{new_y1}_CD.png",
-                "content": encoded_image_cd,
-                "decode": True,
-                "is_private": True
-            })
-            file_doc_cd.insert(ignore_permissions=True)
-
-            extracted_cell_doc = frappe.get_doc({
-                "doctype": "Extracted Cell",
+        # Decode the smear once and slice every cell out of the same array
+        if image is None:
+            with metrics.span("decode"), Image.open(blood_smear_image_path) as smear:
+                image = np.asarray(smear.convert("RGB"))
+
+        boxes, labels, _ = load_detections(cell_detection_image_doc)
+
+        crops, crop_boxes, classifications = [], [], []
+        with metrics.span("post_processing"):
+            for (x1, y1, x2, y2), label in zip(boxes.astype(int).tolist(), labels.tolist()):
+                crop, new_x1, new_y1 = crop_cell(image, x1, y1, x2, y2)
+
+                crops.append(crop)
+                # The outline is drawn from the box when the crop is served, not stored as a second image
+                crop_boxes.append([x1 - new_x1, y1 - new_y1, x2 - new_x1, y2 - new_y1])
+                classifications.append(CLASSES[label-1])
+        metrics.count_cells(len(classifications))
+
+        # One atlas File, and the cells with multi-row inserts, inside one transaction
+        atlas = save_atlas(cell_detection_image_id, crops) if crops else None
+        names = reserve_names("Extracted Cell", len(crops))
+
+        last_cell_number = frappe.db.get_value("Extracted Cell",
+                                               {"cell_detection_image": cell_detection_image_id},
+                                               "max(cell_number)") or 0
+        cells = [
+            {
+                "name": name,
                 "cell_detection_image": cell_detection_image_id,
-                "cell_image": file_doc.file_url,
+                "cell_image": get_cell_image_url(name),
                 "primary_classification": classification,
-                "cell_detection_result": file_doc_cd.file_url,
-                "cell_number": len(extracted_cells) + 1
-            })
-            extracted_cell_doc.insert(ignore_permissions=True)
-
-            extracted_cells.append({
-                "cell_image_url": file_doc.file_url,
-                "predicted_label": classification
-            })
+                "cell_detection_result": get_cell_image_url(name, outline=True),
+                "cell_atlas": atlas.file_url,
+                "atlas_slot": slot,
+                "crop_box": json.dumps(crop_box),
+                "cell_number": last_cell_number + slot + 1
+            }
+            for slot, (name, crop_box, classification) in enumerate(zip(names, crop_boxes, classifications))
+        ]
+        bulk_insert("Extracted Cell", cells)
+        aggregates.record_cells(cell_detection_image_id, cells)
+        with metrics.span("db_write"):
+            frappe.db.commit()
+
+    return [
+        {"cell_image_url": cell["cell_image"], "predicted_label": cell["primary_classification"]}
+        for cell in cells
+    ]
 
-            if os.path.exists(extracted_path):
-                os.remove(extracted_path)
+@frappe.whitelist(allow_guest=True)
+def extract_cells():
+    """
+    API to extract individual cell images from the original Blood Smear Image.
+    :return: JSON response with extracted cell details.
+    """
+    try:
+        if frappe.request.method != "POST":
+            return {"message": "Invalid request method. Use POST.", "status": "failed"}
 
-            if os.path.exists(extracted_path_cd):
-                os.remove(extracted_path_cd)
+        cell_detection_image_id = frappe.form_dict.get("cell_detection_image_id")
+        extracted_cells = run_extraction(cell_detection_image_id)
 
         return {
             "message": "Cells extracted and saved successfully!",
@@ -1,21 +1,21 @@
-import os
+from contextlib import nullcontext
+
 import torch
 from torchvision import transforms
 from PIL import Image
 import frappe
-from frappe.utils.file_manager import get_file_path
 import torch.nn as nn
 import timm
-import numpy as np
-import cv2
-import base64
-from io import BytesIO
+from medical_imaging.api import aggregates, metrics, model_registry, model_server, optimization
+from medical_imaging.api.cell_atlas import load_cell_image
+from medical_imaging.doctype.blood_cell_analysis_configuration.blood_cell_analysis_configuration import (get_classification_batch_size, get_classification_processes, get_generate_xai_on_classification, get_inference_configuration)
 
 
 class EfficientNetB4(nn.Module):
-    def __init__(self, num_classes):
+    def __init__(self, num_classes, pretrained=False):
         super(EfficientNetB4, self).__init__()
-        self.efficientnet_b4 = timm.create_model('tf_efficientnet_b4', pretrained=True)
+        # ImageNet weights are only useful for training; inference overwrites them from the checkpoint
+        self.efficientnet_b4 = timm.create_model('tf_efficientnet_b4', pretrained=pretrained)
         num_ftrs = self.efficientnet_b4.get_classifier().in_features
         self.efficientnet_b4.classifier = nn.Linear(num_ftrs, num_classes)
 
@@ -29,35 +29,45 @@ def load_model(model_path, num_classes):
     model.eval()
     return model
 
-configurations = frappe.get_single("Blood Cell Analysis Configuration")
-model_path = configurations.classification_model_path
 num_classes = 3  # Change this based on your dataset
-model = load_model(model_path, num_classes)
 device = torch.device('cpu')
 
-class GradCAM:
-    def __init__(self, model, target_layer):
-        self.model = model
-        self.target_layer = target_layer
-        self.gradients = None
-        self.feature_maps = None
-        self.target_layer.register_forward_hook(self.save_feature_maps)
-        self.target_layer.register_backward_hook(self.save_gradients)
-
-    def save_feature_maps(self, module, input, output):
-        self.feature_maps = output.detach()
-
-    def save_gradients(self, module, grad_input, grad_output):
-        self.gradients = grad_output[0].detach()
-
-    def generate_cam(self):
-        grad_weights = torch.mean(self.gradients, dim=(2, 3), keepdim=True)
-        cam = torch.mul(self.feature_maps, grad_weights)
-        cam = torch.sum(cam, dim=1)
-        cam = torch.relu(cam)
-        cam -= cam.min()
-        cam /= cam.max()
-        return cam.detach().cpu().numpy()
+def build_classifier(model_path):
+    return load_model(model_path, num_classes)
+
+def build_optimized_classifier(model_path):
+    return optimization.optimize_classifier(build_classifier(model_path))
+
+def get_classifier(optimized=None):
+    """
+    EfficientNet-B4 classifier for this worker, loaded on first use and reused afterwards.
+    :param optimized: use the frozen CPU variant (int8 head, fp32 convolutions); defaults to the
+        Optimized Inference setting.
+    """
+    optimization.apply_thread_settings()
+    if optimized is None:
+        optimized = get_inference_configuration().optimized
+
+    model_path = frappe.db.get_single_value("Blood Cell Analysis Configuration", "classification_model_path")
+    if optimized:
+        return model_registry.get_model("classifier:optimized", model_path, build_optimized_classifier)
+    return model_registry.get_model("classifier", model_path, build_classifier)
+
+def run_classifier(batch):
+    """
+    Classifier logits for an NxCxHxW tensor, from the local model server when it is
+    enabled and from this worker's cached classifier otherwise.
+    """
+    if model_server.is_enabled():
+        try:
+            with metrics.span("inference"):
+                return model_server.classify(batch)
+        except OSError as e:
+            frappe.logger().warning(f"Model server unavailable, classifying in-process: {e}")
+
+    model = get_classifier()
+    with metrics.span("inference"), torch.inference_mode():
+        return model(batch)
 
 transform = transforms.Compose([
     transforms.Resize((224, 224)),
@@ -65,12 +75,23 @@ transform = transforms.Compose([
 ])
 
 def load_image(image_path):
-    img = Image.open(image_path).convert('RGB')
-    img_tensor = transform(img).unsqueeze(0)
+    with metrics.span("decode"):
+        img = Image.open(image_path).convert('RGB')
+        img_tensor = transform(img).unsqueeze(0)
     return img, img_tensor
 
+def load_cell(cell):
+    """
+    Crop and model input of an Extracted Cell, read from its atlas slot (or its own file for
+    cells extracted before atlases); (None, None) when the image is missing.
+    """
+    with metrics.span("decode"):
+        img = load_cell_image(cell)
+        if img is None:
+            return None, None
+        return img, transform(img).unsqueeze(0)
+
 def classify_extracted_cell(cell_id):
-    classes = ["Circular", "Elongated", "Other"]
     try:
         if not cell_id:
             return {"status": "error", "message": "extracted_cell_id is required"}
@@ -79,65 +100,16 @@ def classify_extracted_cell(cell_id):
         if not extracted_cell.cell_image:
             return {"status": "error", "message": "cell_image not found"}
 
-        image_path = get_file_path(extracted_cell.cell_image)
-        if not image_path:
+        updates = classify_extracted_cells_batch([extracted_cell])
+        if not updates:
             return {"status": "error", "message": "Image file not found on the server"}
 
-        original_img = Image.open(image_path).convert('RGB')
-        img_tensor = transform(original_img).unsqueeze(0)
-
-        target_layer = model.efficientnet_b4.conv_head
-        gradcam = GradCAM(model, target_layer)
-
-        output = model(img_tensor)
-        pred_class = output.argmax(dim=1).item()
-
-        model.zero_grad()
-        output[0, pred_class].backward()
-
-        heatmap = gradcam.generate_cam()[0]
-
-        # Resize and smooth the heatmap
-        heatmap = cv2.resize(heatmap, (original_img.width, original_img.height))
-        heatmap = cv2.GaussianBlur(heatmap, (5, 5), 0)  # Add smoothing
-        heatmap = np.uint8(255 * heatmap)
-        heatmap = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
-
-        # Convert original image to BGR for OpenCV
-        img_cv = np.array(original_img)
-        img_cv = cv2.cvtColor(img_cv, cv2.COLOR_RGB2BGR)
-
-        # Overlay heatmap with adjusted weights
-        superimposed_img = cv2.addWeighted(img_cv, 0.5, heatmap, 0.5, 0)
-
-        # Convert BGR to RGB for saving
-        superimposed_img_rgb = cv2.cvtColor(superimposed_img, cv2.COLOR_BGR2RGB)
-
-        # Save in memory instead of disk
-        buffered = BytesIO()
-        pil_image = Image.fromarray(superimposed_img_rgb)
-        pil_image.save(buffered, format="JPEG")
-        file_content = buffered.getvalue()
-        file_content_base64 = base64.b64encode(file_content).decode('utf-8')
-
-        # Upload to Frappe
-        file_name = f"gradcam_{cell_id}.jpg"
-        file_doc = frappe.get_doc({
-            "doctype": "File",
-            "file_name": file_name,
-            "content": file_content_base64,
-            "decode": True,
-            "is_private": True
-        })
-        file_doc.insert(ignore_permissions=True)
-
         # Update the Extracted Cell document
         extracted_cell.reload()
-        extracted_cell.validated_classification = classes[pred_class]
-        extracted_cell.xai_image = file_doc.file_url
+        extracted_cell.validated_classification = updates[cell_id]["validated_classification"]
         extracted_cell.save(ignore_permissions=True)
 
-        return {"status": "success", "validated_classification": classes[pred_class], "xai_image": file_doc.file_url}
+        return {"status": "success", "validated_classification": extracted_cell.validated_classification}
 
     except Exception as e:
         frappe.log_error(f"Classification API Error: {str(e)}", "Deep Learning API")
@@ -146,9 +118,13 @@ def classify_extracted_cell(cell_id):
 @frappe.whitelist()
 def enqueue_classification(cell_detection_image_id):
     try:
+        # Classification resumes where a previous job stopped, so a retry is cheap; the job id
+        # only keeps two jobs from working on the same cells at once
         frappe.enqueue("medical_imaging.api.classification.classify_all_extracted_cells",
                        queue='long',
                        job_name=f"Classify Cells {cell_detection_image_id}",
+                       job_id=f"classify_cells::{cell_detection_image_id}",
+                       deduplicate=True,
                        timeout=600,
                        callback="medical_imaging.api.classification.on_classification_complete",
                        enqueue_after_commit=True,
@@ -158,20 +134,179 @@ def enqueue_classification(cell_detection_image_id):
         frappe.log_error(f"Enqueue Error: {str(e)}", "Deep Learning API")
         return {"status": "error", "message": str(e)}
 
-def classify_all_extracted_cells(cell_detection_image_id, **kwargs):
+def classify_extracted_cells_batch(cells):
+    """
+    Classify a mini-batch of Extracted Cells with a single forward pass and no gradient tracking.
+    Grad-CAM overlays are produced separately by `medical_imaging.api.explainability`.
+    :param cells: list of dicts with `name`, `cell_image`, `cell_atlas` and `atlas_slot`.
+    :return: dict of Extracted Cell name -> field updates.
+    """
+    classes = ["Circular", "Elongated", "Other"]
+    names, tensors = [], []
+    for cell in cells:
+        _, img_tensor = load_cell(cell)
+        if img_tensor is None:
+            frappe.log_error(f"Image file not found for Extracted Cell {cell.name}", "Deep Learning API")
+            continue
+        names.append(cell.name)
+        tensors.append(img_tensor)
+
+    if not tensors:
+        return {}
+
+    pred_classes = run_classifier(torch.cat(tensors).to(device)).argmax(dim=1).tolist()
+
+    return {
+        name: {"validated_classification": classes[pred_class]}
+        for name, pred_class in zip(names, pred_classes)
+    }
+
+@frappe.whitelist()
+def enqueue_classification_batch(cell_detection_image_ids):
+    """
+    API to classify the cells of several Cell Detection Images in one background job that
+    shares a single classifier process pool.
+    :return: JSON response with the queued status.
+    """
+    try:
+        cell_detection_image_ids = frappe.parse_json(cell_detection_image_ids)
+        frappe.enqueue("medical_imaging.api.classification.classify_cell_detection_images",
+                       queue='long',
+                       job_name=f"Classify Cells of {len(cell_detection_image_ids)} Cell Detection Images",
+                       timeout=600 * len(cell_detection_image_ids),
+                       enqueue_after_commit=True,
+                       cell_detection_image_ids=cell_detection_image_ids)
+        return {"status": "queued", "cell_detection_images": len(cell_detection_image_ids)}
+    except Exception as e:
+        frappe.log_error(f"Enqueue Error: {str(e)}", "Deep Learning API")
+        return {"status": "error", "message": str(e)}
+
+def get_classification_pool():
+    """
+    Process pool for classifying cells on several cores, or a null context (in-process
+    classification) when one process is configured or the model server does the inference.
+    """
+    processes = get_classification_processes()
+    if processes <= 1 or model_server.is_enabled():
+        return nullcontext()
+
+    from medical_imaging.api.parallel_classification import classifier_pool
+
+    return classifier_pool(processes)
+
+def iter_classified_batches(cells, batch_size, pool=None):
+    """
+    Classify cells `batch_size` at a time, in this process or across `pool`.
+    :return: generator of (batch, {Extracted Cell name: field updates}, error message or None), in order.
+    """
+    if pool is not None:
+        from medical_imaging.api.parallel_classification import classify_in_pool
+
+        yield from classify_in_pool(pool, cells, batch_size)
+        return
+
+    for start in range(0, len(cells), batch_size):
+        batch = cells[start:start + batch_size]
+        try:
+            updates, error = classify_extracted_cells_batch(batch), None
+        except Exception as e:
+            updates, error = {}, str(e)
+        yield batch, updates, error
+
+def is_classified(cell):
+    return bool(cell.validated_classification) and cell.validated_classification != aggregates.UNCLASSIFIED
+
+def publish_classification_progress(cell_detection_image_id, stage, done, total, cells=None):
+    """
+    Publish `classification_progress` to viewers of the Cell Detection Image after a committed
+    batch, with the validated class counts so far and the cells of the batch.
+    :param stage: "classification" or "xai".
+    """
+    class_counts = aggregates.get_class_counts(cell_detection_image_id, source="Validated")
+    class_counts.pop(aggregates.UNCLASSIFIED, None)
+    frappe.publish_realtime("classification_progress", {
+        "cell_detection_image_id": cell_detection_image_id,
+        "stage": stage,
+        "done": done,
+        "total": total,
+        "class_counts": dict(class_counts),
+        "cells": cells or []
+    }, doctype="Cell Detection Image", docname=cell_detection_image_id)
+
+def classify_cell_detection_images(cell_detection_image_ids, **kwargs):
+    """Background job classifying several Cell Detection Images with one shared process pool."""
+    with get_classification_pool() as pool:
+        for cell_detection_image_id in cell_detection_image_ids:
+            try:
+                classify_all_extracted_cells(cell_detection_image_id, pool=pool)
+            except Exception as e:
+                frappe.db.rollback()
+                frappe.log_error(f"Classification API Error for {cell_detection_image_id}: {str(e)}", "Deep Learning API")
+
+def classify_all_extracted_cells(cell_detection_image_id, pool=None, **kwargs):
+    """
+    Classify the Extracted Cells of a detection image that have no validated classification
+    yet, committing and publishing progress after every batch. A job that timed out or lost
+    its worker can simply be run again: only the remaining cells are classified and only the
+    missing Grad-CAM overlays rendered.
+    :return: dict with the `total` cells of the image and how many are `classified` and `failed`.
+    """
     extracted_cells = frappe.get_all("Extracted Cell",
                                      filters={"cell_detection_image": cell_detection_image_id},
-                                     pluck="name")
+                                     fields=["name", "cell_image", "cell_atlas", "atlas_slot", "primary_classification", "validated_classification"],
+                                     order_by="cell_number asc")
 
     if not extracted_cells:
         frappe.msgprint("No extracted cells found for classification.")
-        return
-
-    for cell_id in extracted_cells:
-        classify_extracted_cell(cell_id)
-
-    frappe.msgprint(f"Classification completed for {len(extracted_cells)} cells.")
+        return frappe._dict(total=0, classified=0, failed=0)
+
+    # Cells classified by an earlier, interrupted run are kept as they are
+    pending = [cell for cell in extracted_cells if not is_classified(cell)]
+    done = len(extracted_cells) - len(pending)
+
+    blood_smear_image = frappe.db.get_value("Cell Detection Image", cell_detection_image_id, "blood_smear_image")
+    with metrics.record_run("Classification", blood_smear_image):
+        metrics.count_cells(len(pending))
+        batch_size = max(1, get_classification_batch_size())
+        # Results come back in cell order whether batches run here or across a process pool
+        with (nullcontext(pool) if pool is not None else get_classification_pool()) as pool:
+            for batch, updates, error in iter_classified_batches(pending, batch_size, pool):
+                try:
+                    if error:
+                        frappe.throw(error)
+                    with metrics.span("db_write"):
+                        frappe.db.bulk_update("Extracted Cell", updates)
+                        aggregates.record_reclassification(cell_detection_image_id, [
+                            (cell.primary_classification, cell.validated_classification,
+                             cell.primary_classification, updates[cell.name]["validated_classification"])
+                            for cell in batch if cell.name in updates
+                        ])
+                        # Each batch is durable on its own, so a retry never redoes it
+                        frappe.db.commit()
+                except Exception as e:
+                    frappe.db.rollback()
+                    frappe.log_error(f"Classification API Error: {str(e)}", "Deep Learning API")
+                    continue
+
+                done += len(updates)
+                publish_classification_progress(cell_detection_image_id, "classification", done, len(extracted_cells), [
+                    {"name": name, "validated_classification": update["validated_classification"]}
+                    for name, update in updates.items()
+                ])
+
+        if get_generate_xai_on_classification():
+            from medical_imaging.api.explainability import generate_xai_images
+
+            generate_xai_images(cell_detection_image_id)
+
+    # Cells of failed batches, or whose image was missing, are left unclassified for a retry
+    failed = len(extracted_cells) - done
+    if failed:
+        frappe.msgprint(f"Classification failed for {failed} of {len(extracted_cells)} cells.")
+    else:
+        frappe.msgprint(f"Classification completed for {len(extracted_cells)} cells.")
     on_classification_complete(cell_detection_image_id)
+    return frappe._dict(total=len(extracted_cells), classified=done, failed=failed)
 
 @frappe.whitelist()
 def on_classification_complete(cell_detection_image_id):
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+from io import BytesIO
+
+import numpy as np
+import frappe
+from medical_imaging.api import disk_cache, model_registry
+from medical_imaging.doctype.blood_cell_analysis_configuration.blood_cell_analysis_configuration import (get_detection_cache_configuration, get_detection_tiling_configuration, get_inference_configuration)
+
+CACHE_FOLDER = "detection_cache"
+
+# Content hashes of weight files, keyed by model_registry._weights_key so each file is hashed once per process
+_weight_hashes = {}
+
+
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_weights_hash(model_path):
+    key = model_registry._weights_key(model_path)
+    if key not in _weight_hashes:
+        _weight_hashes[key] = hash_file(model_path)
+    return _weight_hashes[key]
+
+def get_cache_folder():
+    return disk_cache.get_cache_folder(CACHE_FOLDER)
+
+def get_cache_key(image_path):
+    """
+    Key of the raw detector output for one smear: its content hash, the detector weights'
+    hash and every setting that changes the detector input or the model variant.
+    """
+    model_path = frappe.db.get_single_value("Blood Cell Analysis Configuration", "fasterrcnn_model_path")
+    tiling = get_detection_tiling_configuration()
+    settings = {
+        "mode": tiling.mode,
+        "tile_size": tiling.tile_size if tiling.mode == "Tiled" else None,
+        "overlap": tiling.overlap if tiling.mode == "Tiled" else None,
+        "optimized": bool(get_inference_configuration().optimized),
+    }
+    parts = [hash_file(image_path), get_weights_hash(model_path), json.dumps(settings, sort_keys=True)]
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+def get(key):
+    """Cached (boxes, labels, scores) for `key`, or None. A hit marks the entry as recently used."""
+    content = disk_cache.read(os.path.join(get_cache_folder(), f"{key}.npz"))
+    if content is None:
+        return None
+    try:
+        with np.load(BytesIO(content), allow_pickle=False) as cached:
+            return cached["boxes"], cached["labels"], cached["scores"]
+    except (OSError, KeyError, ValueError):
+        return None
+
+def put(key, prediction, max_entries):
+    """Store raw predictions under `key`, then evict the least recently used entries beyond `max_entries`."""
+    boxes, labels, scores = prediction
+    buffered = BytesIO()
+    np.savez(buffered, boxes=boxes, labels=labels, scores=scores)
+
+    folder = get_cache_folder()
+    disk_cache.write(folder, f"{key}.npz", buffered.getvalue())
+    disk_cache.evict(folder, ".npz", max_entries=max_entries)
+
+def clear():
+    """Drop every cached prediction, e.g. after the detector weights changed."""
+    disk_cache.clear(get_cache_folder())
+
+def get_or_compute(image_path, compute):
+    """
+    Raw detector output for the smear at `image_path`, from the cache when the same content
+    was detected before with the same weights and settings, otherwise from `compute()`.
+    """
+    config = get_detection_cache_configuration()
+    if not config.enabled or not config.max_entries or not image_path or not os.path.exists(image_path):
+        return compute()
+
+    key = get_cache_key(image_path)
+    prediction = get(key)
+    if prediction is not None:
+        return prediction
+
+    prediction = compute()
+    try:
+        put(key, prediction, config.max_entries)
+    except OSError as e:
+        frappe.logger().warning(f"Detection cache write failed: {e}")
+    return prediction
+
+def get_or_compute_many(image_paths, compute_many):
+    """
+    Raw detector outputs for several smears. Cache hits are returned as they are and only the
+    misses are passed, by index, to `compute_many(indices)`, which returns their outputs in order.
+    """
+    config = get_detection_cache_configuration()
+    predictions = [None] * len(image_paths)
+    keys = [None] * len(image_paths)
+    if config.enabled and config.max_entries:
+        for i, image_path in enumerate(image_paths):
+            if image_path and os.path.exists(image_path):
+                keys[i] = get_cache_key(image_path)
+                predictions[i] = get(keys[i])
+
+    missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+    if not missing:
+        return predictions
+
+    for i, prediction in zip(missing, compute_many(missing)):
+        predictions[i] = prediction
+        if keys[i]:
+            try:
+                put(keys[i], prediction, config.max_entries)
+            except OSError as e:
+                frappe.logger().warning(f"Detection cache write failed: {e}")
+    return predictions
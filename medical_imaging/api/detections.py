@@ -0,0 +1,93 @@
+import json
+
+import numpy as np
+import frappe
+from medical_imaging.api.artifacts import load_arrays, save_arrays
+from medical_imaging.api.persistence import bulk_insert_children
+
+CLASSES = ["Circular", "Elongated", "Other"]
+
+
+def pack(boxes, labels, scores):
+    """Compact dtypes for storage: float32 Nx4 boxes and scores, uint8 labels."""
+    return {
+        "boxes": np.asarray(boxes, dtype=np.float32).reshape(-1, 4),
+        "labels": np.asarray(labels, dtype=np.uint8),
+        "scores": np.asarray(scores, dtype=np.float32)
+    }
+
+def save_detections(prediction, file_name):
+    """Store (boxes, labels, scores) as one compressed .npz File and return the File document."""
+    return save_arrays(pack(*prediction), file_name)
+
+def read_detections(file_url):
+    """Decode a .npz written by `save_detections` straight into (boxes, labels, scores) arrays."""
+    arrays = load_arrays(file_url)
+    return arrays["boxes"], arrays["labels"].astype(np.int64), arrays["scores"]
+
+def load_detections(cell_detection_image):
+    """
+    Kept boxes, labels and scores of a Cell Detection Image, from its packed detections or,
+    for images detected before packed storage existed, from its Detection Result rows.
+    :param cell_detection_image: Cell Detection Image name, document or dict with `name` and `detections`.
+    """
+    if isinstance(cell_detection_image, str):
+        cell_detection_image = frappe.db.get_value("Cell Detection Image", cell_detection_image,
+                                                   ["name", "detections"], as_dict=True)
+
+    if cell_detection_image.detections:
+        return read_detections(cell_detection_image.detections)
+
+    rows = frappe.get_all("Detection Result",
+                          filters={"parent": cell_detection_image.name, "parenttype": "Cell Detection Image"},
+                          fields=["bounding_coordinates", "classification", "confidence_score"],
+                          order_by="idx asc")
+    return (
+        np.array([json.loads(row.bounding_coordinates) for row in rows], dtype=np.float32).reshape(-1, 4),
+        np.array([CLASSES.index(row.classification) + 1 if row.classification in CLASSES else len(CLASSES)
+                  for row in rows], dtype=np.int64),
+        np.array([float(json.loads(row.confidence_score)) for row in rows], dtype=np.float32)
+    )
+
+def insert_detection_results(cell_detection_image, boxes, labels, scores):
+    # Detection rows are written with multi-row inserts in the same transaction
+    bulk_insert_children(cell_detection_image, "detection_result", [
+        {
+            "classification": CLASSES[label-1],
+            "confidence_score": json.dumps(score),
+            "bounding_coordinates": json.dumps(box)
+        }
+        for box, label, score in zip(boxes.tolist(), labels.tolist(), scores.tolist())
+    ])
+
+def build_detection_results(cell_detection_image_id):
+    """
+    Materialise the Detection Result rows of a Cell Detection Image from its packed detections.
+    The rows are only a view for the form; nothing in the pipeline reads them.
+    :return: number of rows written, 0 when they already exist.
+    """
+    if frappe.db.exists("Detection Result", {"parent": cell_detection_image_id, "parenttype": "Cell Detection Image"}):
+        return 0
+
+    cell_detection_image = frappe.get_doc("Cell Detection Image", cell_detection_image_id)
+    if not cell_detection_image.detections:
+        return 0
+
+    boxes, labels, scores = read_detections(cell_detection_image.detections)
+    insert_detection_results(cell_detection_image, boxes, labels, scores)
+    return len(boxes)
+
+@frappe.whitelist()
+def get_detection_results(cell_detection_image_id):
+    """
+    API to build the Detection Result table of a Cell Detection Image on first view.
+    :return: JSON response with the number of rows written.
+    """
+    try:
+        frappe.get_doc("Cell Detection Image", cell_detection_image_id).check_permission("read")
+        rows = build_detection_results(cell_detection_image_id)
+        frappe.db.commit()
+        return {"status": "success", "rows": rows}
+    except Exception as e:
+        frappe.log_error(f"Detection Result Error: {str(e)}", "Cell Detection")
+        return {"status": "error", "message": str(e)}
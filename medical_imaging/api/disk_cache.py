@@ -0,0 +1,69 @@
+import os
+import shutil
+
+import frappe
+
+
+def get_cache_folder(name):
+    return frappe.get_site_path("private", name)
+
+def read(path):
+    """Bytes of a cache entry, or None. A hit marks the entry as recently used."""
+    try:
+        with open(path, "rb") as f:
+            content = f.read()
+        os.utime(path)
+        return content
+    except OSError:
+        return None
+
+def write(folder, file_name, content):
+    """
+    Store `content` (bytes) as `file_name` in `folder`. The file is written under a temporary
+    name and renamed, so concurrent readers never see a partial entry.
+    """
+    os.makedirs(folder, exist_ok=True)
+    tmp_path = os.path.join(folder, f"{file_name}.{frappe.generate_hash(length=8)}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, os.path.join(folder, file_name))
+
+def evict(folder, suffix, max_entries=None, max_bytes=None):
+    """Remove the least recently used `suffix` entries of `folder` beyond `max_entries` files or `max_bytes`."""
+    entries = []
+    for entry in os.scandir(folder):
+        if entry.name.endswith(suffix):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    # Newest first: keep entries until either budget is exhausted, then drop everything older
+    entries.sort(reverse=True)
+    kept, kept_bytes, full = 0, 0, False
+    for _, size, path in entries:
+        full = full or (max_entries is not None and kept >= max_entries) \
+            or (max_bytes is not None and kept_bytes + size > max_bytes)
+        if not full:
+            kept += 1
+            kept_bytes += size
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def remove(folder, prefix):
+    """Remove every entry of `folder` whose file name starts with `prefix`."""
+    if not os.path.isdir(folder):
+        return
+    for entry in os.scandir(folder):
+        if entry.name.startswith(prefix):
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+def clear(folder):
+    shutil.rmtree(folder, ignore_errors=True)
@@ -0,0 +1,187 @@
+import cv2
+import numpy as np
+import torch
+import frappe
+from medical_imaging.api import metrics
+from medical_imaging.api.artifacts import save_image
+from medical_imaging.api.classification import device, get_classifier, load_cell
+from medical_imaging.doctype.blood_cell_analysis_configuration.blood_cell_analysis_configuration import get_classification_batch_size
+
+
+class GradCAM:
+    """
+    Grad-CAM over `target_layer`. Hooks are only attached inside a `with` block,
+    so the shared classifier carries no hooks between uses.
+    """
+    def __init__(self, model, target_layer):
+        self.model = model
+        self.target_layer = target_layer
+        self.gradients = None
+        self.feature_maps = None
+        self.handles = []
+
+    def __enter__(self):
+        self.handles = [
+            self.target_layer.register_forward_hook(self.save_feature_maps),
+            self.target_layer.register_full_backward_hook(self.save_gradients),
+        ]
+        return self
+
+    def __exit__(self, *exc_info):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.gradients = self.feature_maps = None
+        self.model.zero_grad(set_to_none=True)
+
+    def save_feature_maps(self, module, input, output):
+        self.feature_maps = output.detach()
+
+    def save_gradients(self, module, grad_input, grad_output):
+        self.gradients = grad_output[0].detach()
+
+    def generate_cam(self):
+        grad_weights = torch.mean(self.gradients, dim=(2, 3), keepdim=True)
+        cam = torch.mul(self.feature_maps, grad_weights)
+        cam = torch.sum(cam, dim=1)
+        cam = torch.relu(cam)
+        # Normalise every map in the batch independently
+        cam -= cam.amin(dim=(1, 2), keepdim=True)
+        cam /= cam.amax(dim=(1, 2), keepdim=True).clamp(min=1e-8)
+        return cam.detach().cpu().numpy()
+
+    def __call__(self, img_tensor):
+        """
+        Heatmaps for the predicted class of every image in the batch. Samples do not
+        interact in eval mode, so a single backward pass yields every sample's gradients.
+        """
+        self.model.zero_grad()
+        output = self.model(img_tensor)
+        pred_classes = output.argmax(dim=1)
+        output.gather(1, pred_classes.unsqueeze(1)).sum().backward()
+        return self.generate_cam()
+
+def save_gradcam_image(cell_id, original_img, heatmap):
+    with metrics.span("post_processing"):
+        # Resize and smooth the heatmap
+        heatmap = cv2.resize(heatmap, (original_img.width, original_img.height))
+        heatmap = cv2.GaussianBlur(heatmap, (5, 5), 0)  # Add smoothing
+        heatmap = np.uint8(255 * heatmap)
+        heatmap = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
+
+        # Convert original image to BGR for OpenCV
+        img_cv = np.array(original_img)
+        img_cv = cv2.cvtColor(img_cv, cv2.COLOR_RGB2BGR)
+
+        # Overlay heatmap with adjusted weights
+        superimposed_img = cv2.addWeighted(img_cv, 0.5, heatmap, 0.5, 0)
+
+        # Convert BGR to RGB for saving
+        superimposed_img_rgb = cv2.cvtColor(superimposed_img, cv2.COLOR_BGR2RGB)
+
+    # Upload to Frappe straight from memory, attached to the cell so a retry can find it
+    file_doc = save_image(superimposed_img_rgb, f"gradcam_{cell_id}.jpg", format="JPEG",
+                          attached_to_doctype="Extracted Cell", attached_to_name=cell_id)
+    return file_doc
+
+def get_existing_gradcam_images(cell_ids):
+    """
+    Grad-CAM Files already rendered for these cells, e.g. by a job that stopped before writing
+    them back, so they are reused instead of rendered and stored a second time.
+    :return: dict of Extracted Cell name -> file_url.
+    """
+    files = frappe.get_all("File",
+                           filters={"attached_to_doctype": "Extracted Cell",
+                                    "attached_to_name": ["in", cell_ids],
+                                    "file_name": ["like", "gradcam_%"]},
+                           fields=["attached_to_name", "file_url"],
+                           order_by="creation asc")
+    return {file.attached_to_name: file.file_url for file in files}
+
+def explain_cells_batch(cells):
+    """
+    Build Grad-CAM overlays for a mini-batch of Extracted Cells with one explainer.
+    :param cells: list of dicts with `name`, `cell_image`, `cell_atlas` and `atlas_slot`.
+    :return: dict of Extracted Cell name -> {"xai_image": file_url}.
+    """
+    existing = get_existing_gradcam_images([cell.name for cell in cells]) if cells else {}
+    names, images, tensors = [], [], []
+    for cell in cells:
+        if cell.name in existing:
+            continue
+        original_img, img_tensor = load_cell(cell)
+        if img_tensor is None:
+            frappe.log_error(f"Image file not found for Extracted Cell {cell.name}", "Deep Learning API")
+            continue
+        names.append(cell.name)
+        images.append(original_img)
+        tensors.append(img_tensor)
+
+    updates = {name: {"xai_image": file_url} for name, file_url in existing.items()}
+    if not tensors:
+        return updates
+
+    # Grad-CAM needs gradients and the conv_head module, so always use the eager fp32 classifier
+    model = get_classifier(optimized=False)
+    with metrics.span("inference"), GradCAM(model, model.efficientnet_b4.conv_head) as gradcam:
+        heatmaps = gradcam(torch.cat(tensors).to(device))
+
+    updates.update({
+        name: {"xai_image": save_gradcam_image(name, original_img, heatmap).file_url}
+        for name, original_img, heatmap in zip(names, images, heatmaps)
+    })
+    return updates
+
+def generate_xai_images(cell_detection_image_id, **kwargs):
+    """
+    Background job: Grad-CAM overlays for every cell of a detection image that lacks one,
+    committed and reported batch by batch.
+    """
+    from medical_imaging.api.classification import publish_classification_progress
+
+    total = frappe.db.count("Extracted Cell", {"cell_detection_image": cell_detection_image_id})
+    extracted_cells = frappe.get_all("Extracted Cell",
+                                     filters={"cell_detection_image": cell_detection_image_id,
+                                              "xai_image": ["is", "not set"]},
+                                     fields=["name", "cell_image", "cell_atlas", "atlas_slot"],
+                                     order_by="cell_number asc")
+
+    done = total - len(extracted_cells)
+    batch_size = max(1, get_classification_batch_size())
+    for start in range(0, len(extracted_cells), batch_size):
+        try:
+            updates = explain_cells_batch(extracted_cells[start:start + batch_size])
+            with metrics.span("db_write"):
+                frappe.db.bulk_update("Extracted Cell", updates)
+                frappe.db.commit()
+        except Exception as e:
+            frappe.db.rollback()
+            frappe.log_error(f"Grad-CAM Error: {str(e)}", "Deep Learning API")
+            continue
+
+        done += len(updates)
+        publish_classification_progress(cell_detection_image_id, "xai", done, total)
+
+@frappe.whitelist()
+def get_xai_image(extracted_cell_id):
+    """
+    API returning the Grad-CAM overlay of one Extracted Cell, rendering it on first request.
+    :return: JSON response with the xai_image URL.
+    """
+    try:
+        extracted_cell = frappe.get_doc("Extracted Cell", extracted_cell_id)
+        extracted_cell.check_permission("read")
+
+        if not extracted_cell.xai_image:
+            updates = explain_cells_batch([extracted_cell])
+            if not updates:
+                return {"status": "error", "message": "Image file not found on the server"}
+
+            frappe.db.set_value("Extracted Cell", extracted_cell.name, updates[extracted_cell.name])
+            extracted_cell.xai_image = updates[extracted_cell.name]["xai_image"]
+
+        return {"status": "success", "xai_image": extracted_cell.xai_image}
+
+    except Exception as e:
+        frappe.log_error(f"Grad-CAM Error: {str(e)}", "Deep Learning API")
+        return {"status": "error", "message": str(e)}
@@ -0,0 +1,144 @@
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import frappe
+from frappe.utils import add_to_date, now_datetime
+
+QUANTILES = (0.5, 0.95, 0.99)
+METRIC_PREFIX = "medical_imaging"
+
+
+class RunRecorder:
+    """Per-span durations and call counts of one detection, extraction, classification or pipeline run."""
+    def __init__(self, operation, blood_smear_image):
+        self.operation = operation
+        self.blood_smear_image = blood_smear_image
+        self.cell_count = 0
+        self.spans = {}
+        self.start = time.perf_counter()
+
+    def add(self, name, duration):
+        total, calls = self.spans.get(name, (0.0, 0))
+        self.spans[name] = (total + duration, calls + 1)
+
+    def save(self):
+        duration = time.perf_counter() - self.start
+        doc = frappe.get_doc({
+            "doctype": "Analysis Run Metrics",
+            "blood_smear_image": self.blood_smear_image,
+            "operation": self.operation,
+            "cell_count": self.cell_count,
+            "duration": duration,
+            "cells_per_second": self.cell_count / duration if duration else 0,
+            "spans": [{"span": name, "duration": total, "calls": calls} for name, (total, calls) in self.spans.items()]
+        })
+        doc.insert(ignore_permissions=True)
+        return doc
+
+
+def get_active_run():
+    return getattr(frappe.local, "analysis_run", None)
+
+@contextmanager
+def record_run(operation, blood_smear_image):
+    """
+    Collect the spans of one successful run into an Analysis Run Metrics record. A run
+    started inside another one (e.g. detection inside the pipeline) joins the outer run.
+    """
+    active = get_active_run()
+    if active:
+        yield active
+        return
+
+    recorder = frappe.local.analysis_run = RunRecorder(operation, blood_smear_image)
+    try:
+        yield recorder
+    finally:
+        frappe.local.analysis_run = None
+
+    # Only reached when the run succeeded; metrics must never fail the analysis itself
+    try:
+        recorder.save()
+        frappe.db.commit()
+    except Exception as e:
+        frappe.log_error(f"Metrics Error: {str(e)}", "Analysis Metrics")
+
+@contextmanager
+def span(name):
+    """Time a block as span `name` of the active run; a no-op outside a run."""
+    recorder = get_active_run()
+    if not recorder:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add(name, time.perf_counter() - start)
+
+def count_cells(count):
+    """Record how many cells the active run handled; nested stages report the same cells again."""
+    recorder = get_active_run()
+    if recorder:
+        recorder.cell_count = max(recorder.cell_count, count)
+
+def get_window_metrics(window_minutes):
+    runs = frappe.get_all("Analysis Run Metrics",
+                          filters={"creation": [">=", add_to_date(now_datetime(), minutes=-window_minutes)]},
+                          fields=["name", "operation", "cell_count", "duration"])
+    spans = frappe.get_all("Analysis Run Span",
+                           filters={"parenttype": "Analysis Run Metrics", "parent": ["in", [run.name for run in runs]]},
+                           fields=["parent", "span", "duration"]) if runs else []
+    return runs, spans
+
+def _labels(**labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+def _summary(lines, metric, help_text, samples):
+    """Append a Prometheus summary with p50/p95/p99 quantiles for every label set in `samples`."""
+    lines.append(f"# HELP {metric} {help_text}")
+    lines.append(f"# TYPE {metric} summary")
+    for labels, values in sorted(samples.items()):
+        labels = dict(labels)
+        for quantile, value in zip(QUANTILES, np.percentile(values, [q * 100 for q in QUANTILES])):
+            lines.append(f"{metric}{_labels(**labels, quantile=quantile)} {value:.6f}")
+        lines.append(f"{metric}_sum{_labels(**labels)} {sum(values):.6f}")
+        lines.append(f"{metric}_count{_labels(**labels)} {len(values)}")
+
+@frappe.whitelist()
+def export(window_minutes=60):
+    """
+    API exporting rolling per-stage latencies and throughput over the last `window_minutes`
+    in the Prometheus text format, for scraping with an API key of a System Manager.
+    :return: text/plain response.
+    """
+    frappe.only_for("System Manager")
+    runs, spans = get_window_metrics(int(window_minutes))
+    operation_of = {run.name: run.operation for run in runs}
+
+    run_samples, span_samples, cells, seconds = {}, {}, {}, {}
+    for run in runs:
+        run_samples.setdefault((("operation", run.operation),), []).append(run.duration)
+        cells[run.operation] = cells.get(run.operation, 0) + run.cell_count
+        seconds[run.operation] = seconds.get(run.operation, 0) + run.duration
+    for row in spans:
+        span_samples.setdefault((("operation", operation_of[row.parent]), ("span", row.span)), []).append(row.duration)
+
+    lines = []
+    _summary(lines, f"{METRIC_PREFIX}_run_duration_seconds",
+             f"Wall time of successful runs over the last {window_minutes} minutes.", run_samples)
+    _summary(lines, f"{METRIC_PREFIX}_span_duration_seconds",
+             f"Time spent per span and run over the last {window_minutes} minutes.", span_samples)
+
+    metric = f"{METRIC_PREFIX}_cells_per_second"
+    lines.append(f"# HELP {metric} Cells handled per second of run time over the last {window_minutes} minutes.")
+    lines.append(f"# TYPE {metric} gauge")
+    for operation in sorted(cells):
+        rate = cells[operation] / seconds[operation] if seconds[operation] else 0
+        lines.append(f"{metric}{_labels(operation=operation)} {rate:.6f}")
+
+    from werkzeug.wrappers import Response
+
+    return Response("\n".join(lines) + "\n", content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+
+import frappe
+from medical_imaging.api import metrics
+
+# Models loaded in this worker process, keyed by registry name
+_models = {}
+_lock = threading.Lock()
+
+
+def _weights_key(model_path):
+    """
+    Identify a weight file by its path, modification time and size so that a
+    replaced checkpoint is picked up even when the configured path is unchanged.
+    """
+    stat = os.stat(model_path)
+    return (os.path.abspath(model_path), stat.st_mtime_ns, stat.st_size)
+
+
+def get_model(name, model_path, builder):
+    """
+    Return the model registered under `name`, calling `builder(model_path)` only when
+    nothing is cached yet or the weight file differs from the one last loaded.
+    """
+    if not model_path or not os.path.exists(model_path):
+        frappe.throw(f"Model weights not found at {model_path}. Please check Blood Cell Analysis Configuration.")
+
+    key = _weights_key(model_path)
+    entry = _models.get(name)
+    if entry and entry["key"] == key:
+        return entry["model"]
+
+    with _lock:
+        entry = _models.get(name)
+        if entry and entry["key"] == key:
+            return entry["model"]
+
+        start = time.perf_counter()
+        with metrics.span("model_load"):
+            model = builder(model_path)
+        load_time = time.perf_counter() - start
+
+        _models[name] = {"key": key, "model": model, "load_time": load_time}
+        frappe.logger().info(f"Model Registry: loaded {name} from {model_path} in {load_time:.2f}s")
+        return model
+
+
+def invalidate(name=None):
+    """
+    Drop one cached model and its variants (e.g. "detector" and "detector:optimized"),
+    or all of them, so the next request reloads from disk.
+    """
+    with _lock:
+        for key in list(_models):
+            if not name or key == name or key.startswith(f"{name}:"):
+                del _models[key]
+
+
+def get_loaded_models():
+    """Models held by this process and how long each took to load, in seconds."""
+    return {
+        name: {"weights": entry["key"][0], "load_time": round(entry["load_time"], 3)}
+        for name, entry in _models.items()
+    }
+
+
+def warm_up():
+    """
+    Load the detector and classifier into this process. Safe to call repeatedly. Models live
+    per process, so this only saves a later load in the process that calls it: the model
+    server's `serve` and `warm_up_models` use it that way, while
+    `bench execute medical_imaging.api.model_registry.warm_up` only checks that the
+    configured weights load. Use the model server to keep the models loaded for every worker.
+    """
+    from medical_imaging.api.cell_detection import get_detector
+    from medical_imaging.api.classification import get_classifier
+
+    get_detector()
+    get_classifier()
+    return get_loaded_models()
+
+
+@frappe.whitelist()
+def status():
+    """Models held by the web worker answering this request."""
+    frappe.only_for("System Manager")
+    return get_loaded_models()
+
+
+@frappe.whitelist()
+def warm_up_models():
+    """
+    API loading the detector and classifier into the web worker answering this request.
+    :return: JSON response with the models this worker now holds.
+    """
+    frappe.only_for("System Manager")
+    return {"status": "success", "models": warm_up()}
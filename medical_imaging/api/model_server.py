@@ -0,0 +1,243 @@
+import json
+import math
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from io import BytesIO
+
+import numpy as np
+import frappe
+from medical_imaging.doctype.blood_cell_analysis_configuration.blood_cell_analysis_configuration import get_model_server_configuration
+
+# Wire format: a 4-byte header length, a JSON header, then each array as an 8-byte length and .npy bytes
+HEADER_LENGTH = struct.Struct(">I")
+ARRAY_LENGTH = struct.Struct(">Q")
+
+# Detection answers every image with boxes, labels and scores; classification with one logits array
+RESULTS_PER_ARRAY = {"detect": 3, "classify": 1}
+
+
+class ModelServerError(ConnectionError):
+    """The model server answered a request with an error; callers fall back to in-process inference."""
+
+
+def get_item_size(op, array):
+    # A detection array is one image (smear or tile); a classification array holds a batch of cells
+    return len(array) if op == "classify" else 1
+
+def split_batch(op, arrays, max_batch_size):
+    """
+    Consecutive groups of `arrays` of at most `max_batch_size` items each, so the server never
+    runs more than that through a model at once. A larger single array forms a group of its own.
+    """
+    group, size = [], 0
+    for array in arrays:
+        item_size = get_item_size(op, array)
+        if group and size + item_size > max_batch_size:
+            yield group
+            group, size = [], 0
+        group.append(array)
+        size += item_size
+    if group:
+        yield group
+
+def _read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ConnectionError("Model server connection closed mid-message")
+    return data
+
+def write_message(stream, header, arrays=()):
+    header = dict(header, arrays=len(arrays))
+    payload = json.dumps(header).encode()
+    stream.write(HEADER_LENGTH.pack(len(payload)) + payload)
+    for array in arrays:
+        buffered = BytesIO()
+        np.save(buffered, np.ascontiguousarray(array), allow_pickle=False)
+        stream.write(ARRAY_LENGTH.pack(buffered.tell()) + buffered.getvalue())
+    stream.flush()
+
+def read_message(stream):
+    (size,) = HEADER_LENGTH.unpack(_read_exact(stream, HEADER_LENGTH.size))
+    header = json.loads(_read_exact(stream, size))
+    arrays = []
+    for _ in range(header.pop("arrays")):
+        (size,) = ARRAY_LENGTH.unpack(_read_exact(stream, ARRAY_LENGTH.size))
+        arrays.append(np.load(BytesIO(_read_exact(stream, size)), allow_pickle=False))
+    return header, arrays
+
+
+class _PendingRequest:
+    def __init__(self, arrays, size):
+        self.arrays = arrays
+        self.size = size
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        header, arrays = read_message(self.rfile)
+        op = header.get("op")
+        if op not in self.server.batch_queues:
+            write_message(self.wfile, {"error": f"Unknown operation {op}"})
+            return
+
+        size = sum(get_item_size(op, array) for array in arrays)
+        pending = _PendingRequest(arrays, size)
+        self.server.batch_queues[op].put(pending)
+        pending.done.wait()
+        write_message(self.wfile, {"error": pending.error}, pending.results or [])
+
+
+class ModelServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Holds one detector and one classifier for the whole host and serves every worker
+    over a Unix socket. Requests of the same kind that arrive within `batch_wait`
+    seconds of each other are run together, at most `max_batch_sizes[op]` items (images
+    for "detect", cells for "classify") per forward pass.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, max_batch_sizes, batch_wait=0.01):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, _RequestHandler)
+        os.chmod(socket_path, 0o660)
+        self.max_batch_sizes = max_batch_sizes
+        self.batch_wait = batch_wait
+        self.batch_queues = {"detect": queue.Queue(), "classify": queue.Queue()}
+
+    def start_batchers(self):
+        for op, run in (("detect", run_detect_batch), ("classify", run_classify_batch)):
+            threading.Thread(target=self._batch_loop, args=(op, run), daemon=True).start()
+
+    def _batch_loop(self, op, run):
+        # Each batcher thread needs its own site connection for reading the configuration
+        frappe.init(site=self.site, sites_path=self.sites_path)
+        frappe.connect()
+
+        batch_queue = self.batch_queues[op]
+        max_batch_size = self.max_batch_sizes[op]
+        while True:
+            batch = [batch_queue.get()]
+            size = batch[0].size
+            deadline = time.monotonic() + self.batch_wait
+            while size < max_batch_size:
+                try:
+                    pending = batch_queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                batch.append(pending)
+                size += pending.size
+
+            try:
+                results = []
+                for group in split_batch(op, [array for pending in batch for array in pending.arrays], max_batch_size):
+                    results.extend(run(group))
+                offset = 0
+                for pending in batch:
+                    count = len(pending.arrays) * RESULTS_PER_ARRAY[op]
+                    pending.results = results[offset:offset + count]
+                    offset += count
+            except Exception as e:
+                frappe.log_error(f"Model Server Error: {str(e)}", "Model Server")
+                for pending in batch:
+                    pending.error = str(e)
+            finally:
+                frappe.db.rollback()
+                for pending in batch:
+                    pending.done.set()
+
+
+def run_detect_batch(images):
+    import torch
+    from medical_imaging.api.cell_detection import get_detector
+
+    with torch.no_grad():
+        outputs = get_detector()([torch.from_numpy(image) for image in images])
+
+    results = []
+    for output in outputs:
+        results.extend([output['boxes'].numpy(), output['labels'].numpy(), output['scores'].numpy()])
+    return results
+
+def run_classify_batch(batches):
+    import torch
+    from medical_imaging.api.classification import get_classifier
+
+    sizes = [len(batch) for batch in batches]
+    with torch.inference_mode():
+        logits = get_classifier()(torch.from_numpy(np.concatenate(batches))).numpy()
+    return np.split(logits, np.cumsum(sizes)[:-1])
+
+def serve():
+    """
+    Run the model server in the foreground, e.g. as a Procfile / supervisor entry:
+    `bench --site <site> execute medical_imaging.api.model_server.serve`
+    """
+    config = get_model_server_configuration()
+    server = ModelServer(config.socket_path,
+                         {"detect": config.max_detect_batch_size, "classify": config.max_batch_size},
+                         config.batch_wait_ms / 1000)
+    server.site = frappe.local.site
+    server.sites_path = frappe.local.sites_path
+
+    from medical_imaging.api import model_registry
+
+    model_registry.warm_up()
+    frappe.db.commit()
+
+    server.start_batchers()
+    frappe.logger().info(f"Model Server: listening on {config.socket_path}")
+    server.serve_forever()
+
+def is_enabled():
+    return bool(get_model_server_configuration().enabled)
+
+def request(op, arrays):
+    """Send one request to the local model server and wait for its (batched) answer."""
+    config = get_model_server_configuration()
+    if op == "detect":
+        max_batch_size, timeout = config.max_detect_batch_size, config.detect_timeout
+    else:
+        max_batch_size, timeout = config.max_batch_size, config.timeout
+
+    # The timeout is per forward pass: one for each batch this request needs, plus one
+    # for a batch of other workers' requests that may already be running ahead of it
+    batches = math.ceil(sum(get_item_size(op, array) for array in arrays) / max_batch_size)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        # A hung or overloaded server raises socket.timeout, an OSError like a refused connection
+        client.settimeout(timeout * (batches + 1))
+        client.connect(config.socket_path)
+        with client.makefile("rwb") as stream:
+            write_message(stream, {"op": op}, arrays)
+            header, results = read_message(stream)
+
+    if header.get("error"):
+        raise ModelServerError(f"Model server failed: {header['error']}")
+    return results
+
+def detect(images):
+    """
+    Faster R-CNN outputs for a list of CHW float tensors, computed by the model server.
+    :return: list of dicts with `boxes`, `labels` and `scores` tensors, like the detector itself.
+    """
+    import torch
+
+    results = request("detect", [image.cpu().numpy() for image in images])
+    return [
+        {"boxes": torch.from_numpy(boxes), "labels": torch.from_numpy(labels), "scores": torch.from_numpy(scores)}
+        for boxes, labels, scores in zip(results[0::3], results[1::3], results[2::3])
+    ]
+
+def classify(batch):
+    """Classifier logits for an NxCxHxW tensor, computed by the model server."""
+    import torch
+
+    return torch.from_numpy(request("classify", [batch.cpu().numpy()])[0])
@@ -0,0 +1,163 @@
+import torch
+import torch.nn as nn
+import torchvision
+import frappe
+from frappe.utils import now_datetime
+from medical_imaging.doctype.blood_cell_analysis_configuration.blood_cell_analysis_configuration import get_inference_configuration
+
+# Thread settings already applied to this process
+_applied_threads = {}
+
+ACCURACY_DRIFT_CACHE_KEY = "medical_imaging:accuracy_drift"
+
+
+def apply_thread_settings():
+    """
+    Apply the configured intra-op / inter-op torch thread counts to this worker.
+    Inter-op threads can only be set before the first parallel op, so later changes need a restart.
+    """
+    config = get_inference_configuration()
+
+    if config.num_threads and _applied_threads.get("intra") != config.num_threads:
+        torch.set_num_threads(config.num_threads)
+        _applied_threads["intra"] = config.num_threads
+
+    if config.num_interop_threads and "inter" not in _applied_threads:
+        try:
+            torch.set_num_interop_threads(config.num_interop_threads)
+        except RuntimeError:
+            frappe.logger().warning("Inter-op threads are already in use; restart the worker to change them")
+        _applied_threads["inter"] = config.num_interop_threads
+
+def optimize_classifier(model, input_size=224):
+    """
+    Dynamically int8-quantize the Linear layers of the classifier, then trace and freeze
+    it so that weights are folded into the graph and dispatch overhead disappears.
+    EfficientNet-B4 has a single Linear layer, the 1792 -> 3 head, so only that is int8;
+    every convolution stays fp32 and the gain comes mostly from freezing and fusion.
+    """
+    model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, torch.rand(1, 3, input_size, input_size))
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+
+def optimize_detector(model):
+    """
+    Dynamically int8-quantize the Faster R-CNN box head and predictor (most of the
+    detector's Linear weights) and freeze the scripted box head. The backbone, RPN
+    and post-processing stay eager because they need variable image sizes.
+    """
+    roi_heads = model.roi_heads
+    roi_heads.box_head = torch.ao.quantization.quantize_dynamic(roi_heads.box_head, {nn.Linear}, dtype=torch.qint8)
+    roi_heads.box_predictor = torch.ao.quantization.quantize_dynamic(roi_heads.box_predictor, {nn.Linear}, dtype=torch.qint8)
+    roi_heads.box_head = torch.jit.freeze(torch.jit.script(roi_heads.box_head.eval()))
+    return model
+
+def _box_agreement(reference, candidate):
+    """Mean best-match IoU of the reference boxes and the share matched at IoU >= 0.5."""
+    if not len(reference["boxes"]):
+        return 1.0, 1.0
+    if not len(candidate["boxes"]):
+        return 0.0, 0.0
+    best_iou = torchvision.ops.box_iou(reference["boxes"], candidate["boxes"]).max(dim=1).values
+    return best_iou.mean().item(), (best_iou >= 0.5).float().mean().item()
+
+def compare_optimized_models(cell_limit=200, smear_limit=5, min_class_agreement=0.99, min_box_iou=0.9):
+    """
+    Compare the optimized models with the fp32 ones on a reference set: the latest
+    `cell_limit` Extracted Cells and `smear_limit` Blood Smear Images. Cells or smears whose
+    image cannot be loaded are left out of the comparison and of the counts.
+    :return: class agreement, box IoU statistics and whether both are within tolerance.
+    """
+    from PIL import Image
+    import torchvision.transforms as T
+    from frappe.utils.file_manager import get_file_path
+    from medical_imaging.api.cell_detection import get_detector
+    from medical_imaging.api.classification import get_classifier, load_cell
+
+    cells = frappe.get_all("Extracted Cell", fields=["name", "cell_image", "cell_atlas", "atlas_slot"], filters={"cell_image": ["is", "set"]},
+                           order_by="creation desc", limit=int(cell_limit))
+    cell_tensors = [tensor for _, tensor in map(load_cell, cells) if tensor is not None]
+    smears = frappe.get_all("Blood Smear Image", fields=["image"], filters={"image": ["is", "set"]},
+                            order_by="creation desc", limit=int(smear_limit))
+
+    cells_compared, class_agreement = 0, None
+    if cell_tensors:
+        batch = torch.cat(cell_tensors)
+        with torch.inference_mode():
+            reference = get_classifier(optimized=False)(batch).argmax(dim=1)
+            candidate = get_classifier(optimized=True)(batch).argmax(dim=1)
+        cells_compared = len(batch)
+        class_agreement = (reference == candidate).float().mean().item()
+
+    box_iou, box_match_rate = [], []
+    transforms = T.Compose([T.Resize((2000, 2000)), T.ToTensor()])
+    for smear in smears:
+        try:
+            with Image.open(get_file_path(smear.image)) as img:
+                img_tensor = transforms(img.convert("RGB"))
+        except OSError:
+            continue
+        with torch.no_grad():
+            reference = get_detector(optimized=False)([img_tensor])[0]
+            candidate = get_detector(optimized=True)([img_tensor])[0]
+        mean_iou, match_rate = _box_agreement(reference, candidate)
+        box_iou.append(mean_iou)
+        box_match_rate.append(match_rate)
+
+    mean_box_iou = sum(box_iou) / len(box_iou) if box_iou else None
+    return {
+        "cells_compared": cells_compared,
+        "class_agreement": class_agreement,
+        "smears_compared": len(box_iou),
+        "mean_box_iou": mean_box_iou,
+        "box_match_rate": sum(box_match_rate) / len(box_match_rate) if box_match_rate else None,
+        "within_tolerance": (class_agreement is None or class_agreement >= float(min_class_agreement))
+                            and (mean_box_iou is None or mean_box_iou >= float(min_box_iou))
+    }
+
+def run_accuracy_drift_check(user=None, **kwargs):
+    """
+    Background job running `compare_optimized_models`. The result is kept for
+    `get_accuracy_drift_result` and published to `user` as `accuracy_drift_result`.
+    """
+    try:
+        result = {"status": "success", "checked_at": str(now_datetime()),
+                  **compare_optimized_models(**kwargs)}
+    except Exception as e:
+        frappe.log_error(f"Accuracy Drift Error: {str(e)}", "CPU Inference")
+        result = {"status": "error", "message": str(e)}
+
+    frappe.cache().set_value(ACCURACY_DRIFT_CACHE_KEY, result)
+    frappe.publish_realtime("accuracy_drift_result", result, user=user)
+
+@frappe.whitelist()
+def check_accuracy_drift(cell_limit=200, smear_limit=5, min_class_agreement=0.99, min_box_iou=0.9):
+    """
+    API queueing a comparison of the optimized models with the fp32 ones on the latest
+    `cell_limit` Extracted Cells and `smear_limit` Blood Smear Images. It loads all four
+    models, so it runs on the long queue rather than in the web worker.
+    :return: JSON response; the result follows as the `accuracy_drift_result` realtime event
+        and from `get_accuracy_drift_result`.
+    """
+    frappe.only_for("System Manager")
+    frappe.enqueue("medical_imaging.api.optimization.run_accuracy_drift_check",
+                   queue='long',
+                   job_name="Check Accuracy Drift",
+                   job_id="check_accuracy_drift",
+                   deduplicate=True,
+                   user=frappe.session.user,
+                   cell_limit=int(cell_limit),
+                   smear_limit=int(smear_limit),
+                   min_class_agreement=float(min_class_agreement),
+                   min_box_iou=float(min_box_iou))
+    return {"status": "queued"}
+
+@frappe.whitelist()
+def get_accuracy_drift_result():
+    """
+    API returning the result of the last accuracy drift check.
+    :return: JSON response with the comparison, or status "not_run".
+    """
+    frappe.only_for("System Manager")
+    return frappe.cache().get_value(ACCURACY_DRIFT_CACHE_KEY) or {"status": "not_run"}
@@ -0,0 +1,100 @@
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+from PIL import Image
+import frappe
+from frappe.utils import flt
+from frappe.utils.file_manager import get_file_path
+from werkzeug.wrappers import Response
+from medical_imaging.api.detections import CLASSES, load_detections, read_detections
+
+CLASS_COLORS = {"Circular": "#2ecc71", "Elongated": "#e74c3c", "Other": "#f39c12"}
+
+
+def get_smear_size(blood_smear_image):
+    # Only the image header is read, the pixels are never decoded
+    image_url = frappe.db.get_value("Blood Smear Image", blood_smear_image, "image")
+    with Image.open(get_file_path(image_url)) as img:
+        return img.size
+
+def get_overlay_detections(cell_detection_image_id, classes=None, min_score=None):
+    """
+    Boxes of a Cell Detection Image to draw, by default its kept detections. With `min_score`
+    (percent) the stored raw predictions are re-filtered with that threshold and the stored
+    area tolerance instead, so another threshold can be previewed without storing anything.
+    :param classes: class names to keep; every class when None.
+    :return: (boxes, labels, scores).
+    """
+    from medical_imaging.api.cell_detection import filter_predictions
+
+    cell_detection_image = frappe.db.get_value("Cell Detection Image", cell_detection_image_id,
+                                               ["name", "detections", "raw_predictions", "area_tolerance"], as_dict=True)
+    if min_score is not None and cell_detection_image.raw_predictions:
+        boxes, labels, scores = filter_predictions(read_detections(cell_detection_image.raw_predictions),
+                                                   flt(min_score) / 100, flt(cell_detection_image.area_tolerance) / 100)
+    else:
+        boxes, labels, scores = load_detections(cell_detection_image)
+        if min_score is not None:
+            keep = scores >= flt(min_score) / 100
+            boxes, labels, scores = boxes[keep], labels[keep], scores[keep]
+
+    if classes is not None:
+        keep = np.isin(labels, [CLASSES.index(name) + 1 for name in classes if name in CLASSES])
+        boxes, labels, scores = boxes[keep], labels[keep], scores[keep]
+    return boxes, labels, scores
+
+def get_class_name(label):
+    return CLASSES[label - 1] if 0 < label <= len(CLASSES) else "Other"
+
+def render_svg(width, height, boxes, labels, scores):
+    """SVG layer in smear pixel coordinates with one outlined rectangle per detection."""
+    rects = [
+        f'<rect x="{x1:.1f}" y="{y1:.1f}" width="{x2 - x1:.1f}" height="{y2 - y1:.1f}" '
+        f'stroke={quoteattr(CLASS_COLORS[get_class_name(label)])} data-score="{score:.3f}"/>'
+        for (x1, y1, x2, y2), label, score in zip(boxes.tolist(), labels.tolist(), scores.tolist())
+    ]
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {width} {height}" '
+        f'width="{width}" height="{height}">'
+        '<style>rect { vector-effect: non-scaling-stroke; }</style>'
+        '<g fill="none" stroke-width="2">'
+        + "".join(rects) +
+        '</g></svg>'
+    )
+
+@frappe.whitelist()
+def get_detection_overlay(cell_detection_image_id, classes=None, min_score=None, format="json"):
+    """
+    API returning the detection overlay of a Cell Detection Image as vector data, drawn from
+    its stored boxes.
+    :param classes: JSON list of class names to include; every class by default.
+    :param min_score: score threshold in percent; the stored detections by default.
+    :param format: "json" for box, class and score arrays, "svg" for an SVG layer.
+    :return: JSON response with the smear size and the detections, or the SVG document.
+    """
+    try:
+        cell_detection_image = frappe.get_doc("Cell Detection Image", cell_detection_image_id)
+        cell_detection_image.check_permission("read")
+
+        classes = None if classes in (None, "") else frappe.parse_json(classes)
+        min_score = None if min_score in (None, "") else flt(min_score)
+        boxes, labels, scores = get_overlay_detections(cell_detection_image_id, classes, min_score)
+        width, height = get_smear_size(cell_detection_image.blood_smear_image)
+
+        if format == "svg":
+            return Response(render_svg(width, height, boxes, labels, scores),
+                            content_type="image/svg+xml; charset=utf-8",
+                            headers={"Cache-Control": "private, no-cache"})
+
+        return {
+            "status": "success",
+            "width": width,
+            "height": height,
+            "boxes": np.round(boxes, 1).tolist(),
+            "classes": [get_class_name(label) for label in labels.tolist()],
+            "scores": np.round(scores, 3).tolist(),
+            "colors": CLASS_COLORS
+        }
+    except Exception as e:
+        frappe.log_error(f"Detection Overlay Error: {str(e)}", "Cell Detection")
+        return {"status": "error", "message": str(e)}
@@ -0,0 +1,90 @@
+import multiprocessing
+from contextlib import contextmanager
+
+import torch
+import frappe
+from medical_imaging.api import metrics
+from medical_imaging.api.cell_atlas import get_cell_source, open_cell_source
+
+CLASSES = ["Circular", "Elongated", "Other"]
+
+# Classifier shared with the pool's forked workers. It is set in the parent before the fork,
+# so every worker reads the same weight pages copy-on-write instead of loading its own copy.
+_shared_model = None
+
+
+def _init_worker():
+    # The parent ran torch ops before forking, and its OpenMP thread pool does not survive a fork;
+    # set_num_threads does not rebuild it. Workers therefore stay single-threaded and the pool's
+    # process count provides the parallelism.
+    torch.set_num_threads(1)
+
+def _classify_chunk(sources):
+    """
+    Runs in a pool worker: decode, transform and classify one chunk of cell images. Workers
+    never touch frappe or the database; the parent resolves sources and writes results.
+    :param sources: (path, atlas slot or None) per cell, from `cell_atlas.get_cell_source`.
+    :return: (class index or None per cell, error message or None).
+    """
+    from medical_imaging.api.classification import transform
+
+    try:
+        indices, tensors = [], []
+        for i, (path, slot) in enumerate(sources):
+            if path:
+                tensors.append(transform(open_cell_source(path, slot)).unsqueeze(0))
+                indices.append(i)
+
+        pred_classes = [None] * len(sources)
+        if tensors:
+            with torch.inference_mode():
+                for i, pred_class in zip(indices, _shared_model(torch.cat(tensors)).argmax(dim=1).tolist()):
+                    pred_classes[i] = pred_class
+        return pred_classes, None
+    except Exception as e:
+        return [None] * len(sources), str(e)
+
+@contextmanager
+def classifier_pool(processes):
+    """
+    Process pool classifying cell chunks with this worker's classifier. The model is loaded
+    (or taken from the registry) and moved to shared memory before the workers are forked.
+    """
+    global _shared_model
+    from medical_imaging.api.classification import get_classifier
+
+    # The registry records a cold load as a model_load span itself
+    _shared_model = get_classifier()
+    _shared_model.share_memory()
+
+    try:
+        with multiprocessing.get_context("fork").Pool(processes, initializer=_init_worker) as pool:
+            yield pool
+    finally:
+        _shared_model = None
+
+def classify_in_pool(pool, cells, batch_size):
+    """
+    Classify cells across the pool, `batch_size` cells per task.
+    :param cells: list of dicts with `name`, `cell_image`, `cell_atlas` and `atlas_slot`.
+    :return: generator of (batch, {Extracted Cell name: field updates}, error message or None),
+        in the order of `cells`, each yielded as soon as its batch and all earlier ones are done.
+    """
+    batches = [cells[start:start + batch_size] for start in range(0, len(cells), batch_size)]
+    chunks = []
+    for batch in batches:
+        sources = [get_cell_source(cell) for cell in batch]
+        for cell, (path, _) in zip(batch, sources):
+            if not path:
+                frappe.log_error(f"Image file not found for Extracted Cell {cell.name}", "Deep Learning API")
+        chunks.append(sources)
+
+    results = pool.imap(_classify_chunk, chunks)
+    for batch in batches:
+        with metrics.span("inference"):
+            pred_classes, error = next(results)
+
+        yield batch, {
+            cell.name: {"validated_classification": CLASSES[pred_class]}
+            for cell, pred_class in zip(batch, pred_classes) if pred_class is not None
+        }, error
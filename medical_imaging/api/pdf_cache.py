@@ -0,0 +1,68 @@
+import hashlib
+import os
+
+import frappe
+from medical_imaging.api import disk_cache
+from medical_imaging.doctype.blood_cell_analysis_configuration.blood_cell_analysis_configuration import get_pdf_cache_configuration
+
+CACHE_FOLDER = "report_pdf_cache"
+
+
+def get_cache_folder():
+    return disk_cache.get_cache_folder(CACHE_FOLDER)
+
+def get_cache_key(doctype, name, print_format, letterhead):
+    """
+    Version of a rendered PDF: the document's `modified` timestamp plus the print format and
+    letterhead, including when those were last edited, so template changes never serve stale bytes.
+    The report prints the linked Patient's details live, so a Patient edit is a new version too.
+    """
+    patient = frappe.db.get_value(doctype, name, "patient") if frappe.get_meta(doctype).has_field("patient") else None
+    parts = [
+        doctype,
+        name,
+        str(frappe.db.get_value(doctype, name, "modified")),
+        patient or "",
+        str(frappe.db.get_value("Patient", patient, "modified") or "") if patient else "",
+        print_format or "",
+        str(frappe.db.get_value("Print Format", print_format, "modified") or "") if print_format else "",
+        letterhead or "",
+        str(frappe.db.get_value("Letter Head", letterhead, "modified") or "") if letterhead else "",
+    ]
+    return hashlib.sha1("\n".join(parts).encode()).hexdigest()
+
+def get_file_prefix(name):
+    # Every cached version of a document shares this prefix, so they can be dropped together
+    return f"{frappe.scrub(name)}--"
+
+def get_or_render(doctype, name, print_format, letterhead, render):
+    """
+    Rendered PDF bytes of a document, from the cache when the same version was rendered before
+    with the same print format and letterhead, otherwise from `render()`.
+    """
+    config = get_pdf_cache_configuration()
+    if not config.max_bytes:
+        return render()
+
+    folder = get_cache_folder()
+    file_name = f"{get_file_prefix(name)}{get_cache_key(doctype, name, print_format, letterhead)}.pdf"
+    pdf_data = disk_cache.read(os.path.join(folder, file_name))
+    if pdf_data is not None:
+        return pdf_data
+
+    pdf_data = render()
+    try:
+        # Older versions of this document can never be served again
+        disk_cache.remove(folder, get_file_prefix(name))
+        disk_cache.write(folder, file_name, pdf_data)
+        disk_cache.evict(folder, ".pdf", max_bytes=config.max_bytes)
+    except OSError as e:
+        frappe.logger().warning(f"Report PDF cache write failed: {e}")
+    return pdf_data
+
+def invalidate(name):
+    """Drop every cached PDF of the document `name`."""
+    disk_cache.remove(get_cache_folder(), get_file_prefix(name))
+
+def clear():
+    disk_cache.clear(get_cache_folder())
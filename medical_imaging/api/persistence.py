@@ -0,0 +1,111 @@
+import re
+
+import frappe
+from frappe.model.naming import parse_naming_series
+from frappe.utils import cint, now
+from medical_imaging.api import metrics
+
+# Same pattern Frappe uses to find {...} params in `format:` autonames
+BRACED_PARAMS_PATTERN = re.compile(r"(\{[\w | #]+\})")
+SERIES_PLACEHOLDER = "\0"
+
+
+def reserve_series(key, count):
+    """
+    Reserve `count` consecutive numbers from the naming series `key` with one
+    locked read and one update, the block-sized version of frappe's getseries.
+    :return: the first reserved number.
+    """
+    series = frappe.qb.DocType("Series")
+    current = frappe.qb.from_(series).where(series.name == key).for_update().select("current").run()
+
+    if current and current[0][0] is not None:
+        first = cint(current[0][0]) + 1
+        frappe.db.sql("UPDATE `tabSeries` SET `current` = `current` + %s WHERE `name` = %s", (count, key))
+    else:
+        first = 1
+        frappe.db.sql("INSERT INTO `tabSeries` (`name`, `current`) VALUES (%s, %s)", (key, count))
+
+    return first
+
+def reserve_names(doctype, count):
+    """
+    Generate `count` document names for `doctype` in one go. `format:` autonames are
+    expanded exactly as Frappe would, except that the counter is bumped once for the
+    whole block; any other naming rule falls back to random hashes.
+    """
+    if not count:
+        return []
+
+    autoname = frappe.get_meta(doctype).autoname or ""
+    if not autoname.startswith("format:"):
+        return [frappe.generate_hash(length=10) for _ in range(count)]
+
+    block = {}
+
+    def reserve(key, digits):
+        block["first"] = reserve_series(key, count)
+        block["digits"] = digits
+        return SERIES_PLACEHOLDER
+
+    template = BRACED_PARAMS_PATTERN.sub(
+        lambda match: parse_naming_series([match.group()[1:-1]], doctype=doctype, number_generator=reserve),
+        autoname[len("format:"):]
+    )
+
+    if "first" not in block:
+        frappe.throw(f"Autoname of {doctype} has no counter, so names cannot be generated in bulk.")
+
+    return [
+        template.replace(SERIES_PLACEHOLDER, str(number).zfill(block["digits"]))
+        for number in range(block["first"], block["first"] + count)
+    ]
+
+def get_static_defaults(doctype):
+    """Field defaults that do not depend on the session, date or another field."""
+    return {
+        df.fieldname: df.default
+        for df in frappe.get_meta(doctype).fields
+        if df.default and df.default not in ("Today", "Now") and not df.default.startswith((":", "__"))
+    }
+
+def bulk_insert(doctype, rows, chunk_size=500):
+    """
+    Insert plain dict rows with multi-row INSERT statements, `chunk_size` rows at a time.
+    Names, standard fields and static defaults are filled in, but controllers and
+    validations are not run, so callers must pass clean values.
+    :return: list of inserted names, in the order of `rows`.
+    """
+    if not rows:
+        return []
+
+    missing = [row for row in rows if not row.get("name")]
+    for row, name in zip(missing, reserve_names(doctype, len(missing))):
+        row["name"] = name
+
+    timestamp = now()
+    user = frappe.session.user
+    standard = {"owner": user, "creation": timestamp, "modified_by": user, "modified": timestamp, "docstatus": 0}
+    defaults = get_static_defaults(doctype)
+
+    fields = list(dict.fromkeys([*standard, *defaults, *(key for row in rows for key in row)]))
+    values = [
+        tuple(row.get(field, standard.get(field, defaults.get(field))) for field in fields)
+        for row in rows
+    ]
+
+    with metrics.span("db_write"):
+        frappe.db.bulk_insert(doctype, fields, values, chunk_size=chunk_size)
+    return [row["name"] for row in rows]
+
+def bulk_insert_children(parent_doc, parentfield, rows, chunk_size=500):
+    """Bulk insert child table rows under an already inserted parent document."""
+    child_doctype = parent_doc.meta.get_field(parentfield).options
+    for idx, row in enumerate(rows, start=1):
+        row.update({
+            "parent": parent_doc.name,
+            "parenttype": parent_doc.doctype,
+            "parentfield": parentfield,
+            "idx": idx
+        })
+    return bulk_insert(child_doctype, rows, chunk_size=chunk_size)
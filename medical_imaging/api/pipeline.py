@@ -0,0 +1,162 @@
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+import frappe
+from frappe.utils import now_datetime
+from frappe.utils.file_manager import get_file_path
+from medical_imaging.api import metrics
+
+PIPELINE_STAGES = ("Detection", "Extraction", "Classification", "Report")
+
+
+@frappe.whitelist()
+def enqueue_pipeline(blood_smear_id):
+    """
+    API to queue the full analysis of a Blood Smear Image as one background job.
+    :return: JSON response with the Pipeline Run tracking the job.
+    """
+    try:
+        frappe.get_doc("Blood Smear Image", blood_smear_id).check_permission("write")
+
+        pipeline_run = frappe.get_doc({
+            "doctype": "Pipeline Run",
+            "blood_smear_image": blood_smear_id,
+            "status": "Queued",
+            "stages": [{"stage": stage, "status": "Pending"} for stage in PIPELINE_STAGES]
+        })
+        pipeline_run.insert(ignore_permissions=True)
+
+        frappe.enqueue("medical_imaging.api.pipeline.run_pipeline",
+                       queue='long',
+                       job_name=f"Analyse Smear {blood_smear_id}",
+                       timeout=3600,
+                       enqueue_after_commit=True,
+                       pipeline_run=pipeline_run.name)
+        return {"status": "queued", "pipeline_run": pipeline_run.name}
+    except Exception as e:
+        frappe.log_error(f"Enqueue Error: {str(e)}", "Analysis Pipeline")
+        return {"status": "error", "message": str(e)}
+
+def publish_progress(pipeline_run, stage, status):
+    frappe.publish_realtime("pipeline_progress", {
+        "pipeline_run": pipeline_run.name,
+        "blood_smear_image": pipeline_run.blood_smear_image,
+        "cell_detection_image": pipeline_run.cell_detection_image,
+        "rbc_morphology_analysis": pipeline_run.rbc_morphology_analysis,
+        "stage": stage,
+        "status": status
+    }, user=pipeline_run.owner)
+
+def save_progress(pipeline_run, stage, status):
+    pipeline_run.save(ignore_permissions=True)
+    frappe.db.commit()
+    publish_progress(pipeline_run, stage, status)
+
+@contextmanager
+def pipeline_stage(pipeline_run, stage):
+    """Mark one stage of a Pipeline Run as running, then completed or failed, and commit each change."""
+    row = next(row for row in pipeline_run.stages if row.stage == stage)
+    row.status = "Running"
+    row.started_at = now_datetime()
+    pipeline_run.current_stage = stage
+    save_progress(pipeline_run, stage, row.status)
+
+    start = time.perf_counter()
+    try:
+        yield row
+    except Exception as e:
+        frappe.db.rollback()
+        row.status = "Failed"
+        row.message = str(e)[:140]
+        raise
+    else:
+        row.status = "Completed"
+    finally:
+        row.duration = time.perf_counter() - start
+        save_progress(pipeline_run, stage, row.status)
+
+def skip_stage(pipeline_run, stage, message):
+    row = next(row for row in pipeline_run.stages if row.stage == stage)
+    row.status = "Skipped"
+    row.message = message
+    save_progress(pipeline_run, stage, row.status)
+
+def apply_workflow_action(doctype, name, action):
+    """
+    Apply a workflow action to a document the way its form buttons do, when the doctype has a
+    workflow and the action is available from the document's current state.
+    """
+    from frappe.model.workflow import apply_workflow, get_transitions, get_workflow_name
+
+    if not get_workflow_name(doctype):
+        return
+
+    doc = frappe.get_doc(doctype, name)
+    if action not in {transition.action for transition in get_transitions(doc)}:
+        frappe.logger().warning(f"Workflow action {action} is not available for {doctype} {name}")
+        return
+    apply_workflow(doc, action)
+
+def run_pipeline(pipeline_run, **kwargs):
+    """
+    Background job running detection, extraction, classification and the RBC Morphology
+    Analysis for one smear. The smear is decoded once and models stay cached in this worker.
+    A smear without detections completes with its Classification and Report stages skipped.
+    The Cell Detection Image goes through the same workflow actions as with the form buttons.
+    """
+    from medical_imaging.api.cell_detection import run_detection
+    from medical_imaging.api.cell_extraction import run_extraction
+    from medical_imaging.api.classification import classify_all_extracted_cells
+    from medical_imaging.api.report import create_rbc_morphology_analysis
+
+    pipeline_run = frappe.get_doc("Pipeline Run", pipeline_run)
+    pipeline_run.status = "Running"
+    pipeline_run.started_at = now_datetime()
+
+    try:
+        # Detection, extraction and classification join this run, so it records the whole pipeline
+        with metrics.record_run("Pipeline", pipeline_run.blood_smear_image):
+            blood_smear_image = frappe.db.get_value("Blood Smear Image", pipeline_run.blood_smear_image, "image")
+            with metrics.span("decode"), Image.open(get_file_path(blood_smear_image)) as smear:
+                img = smear.convert("RGB")
+                image = np.asarray(img)
+
+            with pipeline_stage(pipeline_run, "Detection") as row:
+                cell_detection_image, boxes, _, _ = run_detection(pipeline_run.blood_smear_image, img=img)
+                pipeline_run.cell_detection_image = cell_detection_image.name
+                row.message = f"{len(boxes)} cells detected"
+
+            with pipeline_stage(pipeline_run, "Extraction") as row:
+                extracted_cells = run_extraction(pipeline_run.cell_detection_image, image=image)
+                row.message = f"{len(extracted_cells)} cells extracted"
+                apply_workflow_action("Cell Detection Image", pipeline_run.cell_detection_image, "Extract Cells")
+
+            if extracted_cells:
+                with pipeline_stage(pipeline_run, "Classification") as row:
+                    result = classify_all_extracted_cells(pipeline_run.cell_detection_image)
+                    # A report over unclassified cells would be wrong, so any failed cell fails the run
+                    if result.failed:
+                        frappe.throw(f"{result.failed} of {result.total} cells could not be classified")
+                    row.message = f"{result.classified} cells classified"
+                    apply_workflow_action("Cell Detection Image", pipeline_run.cell_detection_image, "Classify Extracted Cells")
+
+                with pipeline_stage(pipeline_run, "Report"):
+                    rbc_doc = create_rbc_morphology_analysis(pipeline_run.cell_detection_image)
+                    pipeline_run.rbc_morphology_analysis = rbc_doc.name
+                    apply_workflow_action("Cell Detection Image", pipeline_run.cell_detection_image, "Generate Report")
+            else:
+                # An empty smear is a valid result, but there is nothing to classify or report on
+                for stage in ("Classification", "Report"):
+                    skip_stage(pipeline_run, stage, "No cells detected")
+
+        pipeline_run.status = "Completed"
+    except Exception as e:
+        pipeline_run.status = "Failed"
+        pipeline_run.error = frappe.get_traceback()
+        frappe.log_error(f"Pipeline Error: {str(e)}", "Analysis Pipeline")
+    finally:
+        pipeline_run.current_stage = None
+        pipeline_run.finished_at = now_datetime()
+        save_progress(pipeline_run, None, pipeline_run.status)
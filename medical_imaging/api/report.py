@@ -1,4 +1,72 @@
 import frappe
+from medical_imaging.api import aggregates
+
+def get_morphology_counts(cell_detection_image):
+    """
+    Cell counts and percentages of a Cell Detection Image for an RBC Morphology Analysis,
+    from the maintained Cell Classification Counts. A cell counts under its validated
+    classification once it has one and under its primary classification before that.
+    """
+    counts = aggregates.get_class_counts(cell_detection_image)
+    total_cells = sum(counts.values())
+
+    if not total_cells:
+        frappe.throw("No extracted cells found for the given cell_detection_image")
+
+    normal_cell_count = counts["Circular"]
+    sickle_cell_count = counts["Elongated"]
+    other_cell_count = counts["Other"]
+
+    return {
+        "cells_examined": total_cells,
+        "normal_cell_count": normal_cell_count,
+        "sickle_cell_count": sickle_cell_count,
+        "other_cell_count": other_cell_count,
+        "normal_cells_percentage": round(normal_cell_count / total_cells * 100, 2),
+        "sickle_cells_percentage": round(sickle_cell_count / total_cells * 100, 2),
+        "other_cells_percentage": round(other_cell_count / total_cells * 100, 2)
+    }
+
+def create_rbc_morphology_analysis(cell_detection_image):
+    """
+    Count cell types of a Cell Detection Image and create an RBC Morphology Analysis record.
+    :return: the inserted RBC Morphology Analysis document.
+    """
+    counts = get_morphology_counts(cell_detection_image)
+
+    blood_smear_image = frappe.db.get_value("Cell Detection Image", cell_detection_image, "blood_smear_image")
+    patient = frappe.db.get_value("Blood Smear Image", blood_smear_image, "patient")
+
+    # Create RBC Morphology Analysis record
+    rbc_doc = frappe.get_doc({
+        "doctype": "RBC Morphology Analysis",
+        "patient": patient,
+        "cell_detection_image": cell_detection_image,
+        **counts
+    })
+    rbc_doc.insert(ignore_permissions=True)
+    frappe.db.commit()
+
+    return rbc_doc
+
+@frappe.whitelist()
+def refresh_rbc_morphology_analysis(rbc_morphology_analysis):
+    """
+    API to update the counts of an RBC Morphology Analysis after cells were reclassified.
+    :return: JSON response with the refreshed counts.
+    """
+    try:
+        rbc_doc = frappe.get_doc("RBC Morphology Analysis", rbc_morphology_analysis)
+        rbc_doc.check_permission("write")
+        counts = get_morphology_counts(rbc_doc.cell_detection_image)
+        rbc_doc.update(counts)
+        rbc_doc.save()
+
+        return {"status": "success", "rbc_morphology_analysis": rbc_doc.name, **counts}
+
+    except Exception as e:
+        frappe.log_error(f"Error in refresh_rbc_morphology_analysis: {str(e)}", "RBC Morphology Analysis")
+        return {"status": "error", "message": str(e)}
 
 @frappe.whitelist()
 def create_rbc_morphology_analysis_for_image():
@@ -15,54 +83,7 @@ def create_rbc_morphology_analysis_for_image():
 
         cell_detection_image = frappe.form_dict.get("cell_detection_image_id")
 
-        # Fetch all Extracted Cells for the given cell_detection_image
-        extracted_cells = frappe.get_all(
-            "Extracted Cell",
-            filters={"cell_detection_image": cell_detection_image},
-            fields=["name", "primary_classification"]
-        )
-
-        if not extracted_cells:
-            return {"status": "error", "message": "No extracted cells found for the given cell_detection_image"}
-
-        # Initialize counters
-        total_cells = len(extracted_cells)
-        normal_cell_count = 0
-        sickle_cell_count = 0
-        other_cell_count = 0
-
-        # Count cells based on classification
-        for cell in extracted_cells:
-            if cell.primary_classification == "Circular":
-                normal_cell_count += 1
-            elif cell.primary_classification == "Elongated":
-                sickle_cell_count += 1
-            elif cell.primary_classification == "Other":
-                other_cell_count += 1
-
-        # Calculate percentages
-        normal_cells_percentage = (normal_cell_count / total_cells) * 100 if total_cells > 0 else 0
-        sickle_cells_percentage = (sickle_cell_count / total_cells) * 100 if total_cells > 0 else 0
-        other_cells_percentage = (other_cell_count / total_cells) * 100 if total_cells > 0 else 0
-
-        blood_smear_image = frappe.db.get_value("Cell Detection Image", cell_detection_image, "blood_smear_image")
-        patient = frappe.db.get_value("Blood Smear Image", blood_smear_image, "patient")
-
-        # Create RBC Morphology Analysis record
-        rbc_doc = frappe.get_doc({
-            "doctype": "RBC Morphology Analysis",
-            "patient": patient,
-            "cell_detection_image": cell_detection_image,
-            "cells_examined": total_cells,
-            "normal_cell_count": normal_cell_count,
-            "sickle_cell_count": sickle_cell_count,
-            "other_cell_count": other_cell_count,
-            "normal_cells_percentage": round(normal_cells_percentage, 2),
-            "sickle_cells_percentage": round(sickle_cells_percentage, 2),
-            "other_cells_percentage": round(other_cells_percentage, 2)
-        })
-        rbc_doc.insert(ignore_permissions=True)
-        frappe.db.commit()
+        rbc_doc = create_rbc_morphology_analysis(cell_detection_image)
 
         return {
             "status": "success",
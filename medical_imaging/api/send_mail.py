@@ -1,47 +1,193 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import frappe
-from frappe.utils import formatdate
+from frappe.utils import formatdate, now_datetime
+from medical_imaging.api import pdf_cache
+from medical_imaging.doctype.blood_cell_analysis_configuration.blood_cell_analysis_configuration import get_report_email_configuration
 
-@frappe.whitelist()
-def send_rbc_report_email(docname):
-    try:
-        doc = frappe.get_doc("RBC Morphology Analysis", docname)
-        patient = frappe.get_doc("Patient", doc.patient)
+REPORT_PRINT_FORMAT = "Patient Report Mail"
+REPORT_LETTERHEAD = "HemoScan"
 
-        # Generate PDF for the specific document with the correct settings
-        pdf_data = frappe.get_print(
+def render_report_pdf(docname):
+    # Generate PDF for the specific document with the correct settings, reusing the cached
+    # bytes while the document, print format and letterhead are unchanged
+    return pdf_cache.get_or_render(
+        "RBC Morphology Analysis", docname, REPORT_PRINT_FORMAT, REPORT_LETTERHEAD,
+        lambda: frappe.get_print(
             doctype="RBC Morphology Analysis",
-            name=doc.name,
-            print_format="Patient Report Mail",
+            name=docname,
+            print_format=REPORT_PRINT_FORMAT,
             as_pdf=True,
-            letterhead="HemoScan",
+            letterhead=REPORT_LETTERHEAD,
         )
+    )
 
-        # Render custom email body
-        email_html = frappe.render_template("templates/emails/rbc_report_email.html", {
-            "doc": doc,
-            "patient_name": patient.full_name,
-            "test_date": formatdate(doc.creation),
-            "report_id": doc.name,
-            "generation_date": formatdate(doc.modified),
-        })
+@frappe.whitelist()
+def download_report_pdf(docname):
+    """
+    API to download the "Patient Report Mail" PDF of an RBC Morphology Analysis, served from the
+    PDF cache when the report has not changed since it was last rendered.
+    """
+    frappe.get_doc("RBC Morphology Analysis", docname).check_permission("print")
+    frappe.local.response.filename = f"{docname}.pdf"
+    frappe.local.response.filecontent = render_report_pdf(docname)
+    frappe.local.response.type = "pdf"
+
+def get_report_email(docname, pdf_data=None):
+    """
+    Recipient, subject, body and PDF attachment of the report email for one RBC Morphology Analysis.
+    :param pdf_data: the already rendered PDF, rendered here when not given.
+    :return: keyword arguments for frappe.sendmail.
+    """
+    doc = frappe.get_doc("RBC Morphology Analysis", docname)
+    patient = frappe.get_doc("Patient", doc.patient)
+
+    if not patient.email:
+        frappe.throw("No email address found for patient.")
+
+    if pdf_data is None:
+        pdf_data = render_report_pdf(doc.name)
 
-        if not patient.email:
-            frappe.throw("No email address found for patient.")
+    # Render custom email body
+    email_html = frappe.render_template("templates/emails/rbc_report_email.html", {
+        "doc": doc,
+        "patient_name": patient.full_name,
+        "test_date": formatdate(doc.creation),
+        "report_id": doc.name,
+        "generation_date": formatdate(doc.modified),
+    })
+
+    return {
+        "recipients": [patient.email],
+        "subject": f"{patient.full_name}, Your RBC Morphology Report from HemoScan is Ready",
+        "message": email_html,
+        "attachments": [{
+            "fname": f"{doc.name}.pdf",
+            "fcontent": pdf_data
+        }],
+        "reference_doctype": "RBC Morphology Analysis",
+        "reference_name": doc.name
+    }
+
+@frappe.whitelist()
+def send_rbc_report_email(docname):
+    try:
+        email = get_report_email(docname)
 
         # Send the email with PDF attachment
-        frappe.sendmail(
-            recipients=[patient.email],
-            subject=f"{patient.full_name}, Your RBC Morphology Report from HemoScan is Ready",
-            message=email_html,
-            attachments=[{
-                "fname": f"{doc.name}.pdf",
-                "fcontent": pdf_data
-            }],
-            delayed=False
-        )
+        frappe.sendmail(**email, delayed=False)
 
-        return {"status": "success", "message": f"Email sent to {patient.email}"}
+        return {"status": "success", "message": f"Email sent to {email['recipients'][0]}"}
 
     except Exception as e:
         frappe.log_error(frappe.get_traceback(), "RBC Report Email Error")
         return {"status": "error", "message": str(e)}
+
+@frappe.whitelist()
+def enqueue_report_emails(names=None, filters=None):
+    """
+    API to email many RBC reports from one background job, given a list of RBC Morphology
+    Analysis names or a filter. PDFs are rendered in parallel and emails go through the
+    email queue in batches.
+    :return: JSON response with the Report Email Dispatch tracking every report.
+    """
+    try:
+        filters = {"name": ["in", frappe.parse_json(names)]} if names else frappe.parse_json(filters or "{}")
+        names = frappe.get_list("RBC Morphology Analysis", filters=filters, pluck="name", order_by="creation asc")
+        if not names:
+            return {"status": "error", "message": "No RBC Morphology Analysis matches the given names or filters."}
+
+        dispatch = frappe.get_doc({
+            "doctype": "Report Email Dispatch",
+            "status": "Queued",
+            "total": len(names),
+            "items": [{"rbc_morphology_analysis": name, "status": "Pending"} for name in names]
+        })
+        dispatch.insert(ignore_permissions=True)
+
+        frappe.enqueue("medical_imaging.api.send_mail.dispatch_report_emails",
+                       queue='long',
+                       job_name=f"Email RBC Reports {dispatch.name}",
+                       timeout=7200,
+                       enqueue_after_commit=True,
+                       report_email_dispatch=dispatch.name)
+        return {"status": "queued", "report_email_dispatch": dispatch.name, "reports": len(names)}
+    except Exception as e:
+        frappe.log_error(f"Enqueue Error: {str(e)}", "RBC Report Email Error")
+        return {"status": "error", "message": str(e)}
+
+def _connect_render_thread(site, sites_path, user):
+    # Every render thread needs its own site context and database connection
+    frappe.init(site=site, sites_path=sites_path)
+    frappe.connect()
+    frappe.set_user(user)
+
+def _render_report_pdf(docname):
+    try:
+        return render_report_pdf(docname), None
+    except Exception as e:
+        return None, str(e)
+    finally:
+        frappe.db.rollback()
+
+def publish_dispatch_progress(dispatch):
+    frappe.publish_realtime("report_email_progress", {
+        "report_email_dispatch": dispatch.name,
+        "status": dispatch.status,
+        "total": dispatch.total,
+        "queued": dispatch.queued_count,
+        "failed": dispatch.failed_count
+    }, user=dispatch.owner)
+
+def save_dispatch(dispatch):
+    dispatch.save(ignore_permissions=True)
+    frappe.db.commit()
+    publish_dispatch_progress(dispatch)
+
+def dispatch_report_emails(report_email_dispatch, **kwargs):
+    """
+    Background job for a Report Email Dispatch: render the pending reports' PDFs with at most
+    `render_workers` in parallel and queue their emails `batch_size` at a time. Items already
+    queued are skipped, so a failed job can simply be enqueued again.
+    """
+    dispatch = frappe.get_doc("Report Email Dispatch", report_email_dispatch)
+    config = get_report_email_configuration()
+    dispatch.status = "Running"
+    dispatch.started_at = now_datetime()
+    save_dispatch(dispatch)
+
+    pending = [row for row in dispatch.items if row.status != "Queued"]
+    batch_size = max(1, config.batch_size)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, config.render_workers),
+                                initializer=_connect_render_thread,
+                                initargs=(frappe.local.site, frappe.local.sites_path, frappe.session.user)) as pool:
+            for start in range(0, len(pending), batch_size):
+                batch = pending[start:start + batch_size]
+                rendered = pool.map(_render_report_pdf, [row.rbc_morphology_analysis for row in batch])
+
+                for row, (pdf_data, error) in zip(batch, rendered):
+                    try:
+                        if error:
+                            frappe.throw(f"PDF rendering failed: {error}")
+                        email = get_report_email(row.rbc_morphology_analysis, pdf_data)
+                        frappe.sendmail(**email)
+                        row.recipient = email["recipients"][0]
+                        row.status = "Queued"
+                        row.message = None
+                    except Exception as e:
+                        row.status = "Failed"
+                        row.message = str(e)[:140]
+
+                dispatch.queued_count = sum(row.status == "Queued" for row in dispatch.items)
+                dispatch.failed_count = sum(row.status == "Failed" for row in dispatch.items)
+                save_dispatch(dispatch)
+
+        dispatch.status = "Completed"
+    except Exception as e:
+        frappe.db.rollback()
+        dispatch.status = "Failed"
+        frappe.log_error(f"Report Email Dispatch Error: {str(e)}", "RBC Report Email Error")
+    finally:
+        dispatch.finished_at = now_datetime()
+        save_dispatch(dispatch)
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import math
+import os
+
+from PIL import Image
+import frappe
+from frappe.utils import cint
+from frappe.utils.file_manager import get_file_path
+from werkzeug.wrappers import Response
+from medical_imaging.api import disk_cache, metrics
+from medical_imaging.api.artifacts import encode_image
+
+CACHE_FOLDER = "smear_tiles"
+MANIFEST = "pyramid.json"
+TILE_SIZE = 256
+TILE_QUALITY = 85
+# Tile URLs carry the pyramid version, so browsers may keep a current tile for as long as they like
+CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+def get_pyramid_folder(blood_smear_image):
+    return os.path.join(disk_cache.get_cache_folder(CACHE_FOLDER), frappe.scrub(blood_smear_image))
+
+def get_version(image_url):
+    # A new smear file means a new URL, so tiles of the old one are never served for it
+    return hashlib.sha1(f"{image_url}\n{TILE_SIZE}".encode()).hexdigest()[:16]
+
+def get_level_count(width, height):
+    """Deep-zoom levels: level 0 is 1x1 pixel, the last level the full resolution, each twice the previous."""
+    return math.ceil(math.log2(max(width, height, 1))) + 1
+
+def read_manifest(blood_smear_image):
+    try:
+        with open(os.path.join(get_pyramid_folder(blood_smear_image), MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def build_pyramid(blood_smear_image, **kwargs):
+    """
+    Cut the image of a Blood Smear Image into a deep-zoom pyramid of JPEG tiles, once per
+    image file. Each level is downscaled from the one above it, so the smear is decoded once.
+    :return: the pyramid manifest (size, tile size, levels and version).
+    """
+    image_url = frappe.db.get_value("Blood Smear Image", blood_smear_image, "image")
+    if not image_url:
+        frappe.throw(f"Blood Smear Image {blood_smear_image} has no image.")
+
+    version = get_version(image_url)
+    manifest = read_manifest(blood_smear_image)
+    if manifest and manifest["version"] == version:
+        return manifest
+
+    folder = get_pyramid_folder(blood_smear_image)
+    disk_cache.clear(folder)
+
+    with metrics.span("decode"):
+        img = Image.open(get_file_path(image_url)).convert("RGB")
+    width, height = img.size
+    levels = get_level_count(width, height)
+
+    for level in reversed(range(levels)):
+        if level < levels - 1:
+            img = img.resize((math.ceil(img.width / 2), math.ceil(img.height / 2)), Image.BILINEAR)
+
+        level_folder = os.path.join(folder, str(level))
+        for row in range(math.ceil(img.height / TILE_SIZE)):
+            for col in range(math.ceil(img.width / TILE_SIZE)):
+                x, y = col * TILE_SIZE, row * TILE_SIZE
+                tile = img.crop((x, y, min(x + TILE_SIZE, img.width), min(y + TILE_SIZE, img.height)))
+                disk_cache.write(level_folder, f"{col}_{row}.jpg", encode_image(tile, "JPEG", quality=TILE_QUALITY))
+
+    manifest = {
+        "version": version,
+        "width": width,
+        "height": height,
+        "tile_size": TILE_SIZE,
+        "levels": levels
+    }
+    # The manifest is written last: a pyramid without one is incomplete and gets rebuilt
+    disk_cache.write(folder, MANIFEST, json.dumps(manifest).encode())
+    return manifest
+
+def enqueue_pyramid(blood_smear_image, enqueue_after_commit=True):
+    # One build per smear at a time, however many viewers ask for it
+    frappe.enqueue("medical_imaging.api.tiles.build_pyramid",
+                   queue='long',
+                   job_name=f"Build Tiles {blood_smear_image}",
+                   job_id=f"build_tiles::{blood_smear_image}",
+                   deduplicate=True,
+                   enqueue_after_commit=enqueue_after_commit,
+                   blood_smear_image=blood_smear_image)
+
+def clear_pyramid(blood_smear_image):
+    disk_cache.clear(get_pyramid_folder(blood_smear_image))
+
+@frappe.whitelist()
+def get_pyramid(blood_smear_image):
+    """
+    API describing the deep-zoom tile pyramid of a Blood Smear Image. A missing or outdated
+    pyramid is built in the background and reported as "building" until it is ready.
+    :return: JSON response with width, height, tile_size, levels and the version to pass to
+        get_tile, or status "building" for the viewer to poll again.
+    """
+    try:
+        frappe.get_doc("Blood Smear Image", blood_smear_image).check_permission("read")
+        image_url = frappe.db.get_value("Blood Smear Image", blood_smear_image, "image")
+        if not image_url:
+            frappe.throw(f"Blood Smear Image {blood_smear_image} has no image.")
+
+        manifest = read_manifest(blood_smear_image)
+        if not manifest or manifest["version"] != get_version(image_url):
+            # Read-only requests are never committed, so the job must not wait for a commit
+            enqueue_pyramid(blood_smear_image, enqueue_after_commit=False)
+            return {"status": "building"}
+        return {"status": "success", **manifest}
+    except Exception as e:
+        frappe.log_error(f"Tile Pyramid Error: {str(e)}", "Smear Tiles")
+        return {"status": "error", "message": str(e)}
+
+@frappe.whitelist()
+def get_tile(blood_smear_image, level, col, row, v=None):
+    """
+    API serving one JPEG tile of a Blood Smear Image's pyramid. Tiles are only served once
+    the pyramid is built. A response is cacheable for good when the URL carries the current
+    pyramid version `v`, and must be revalidated otherwise; revalidation is answered with
+    304 by ETag.
+    """
+    frappe.get_doc("Blood Smear Image", blood_smear_image).check_permission("read")
+    level, col, row = cint(level), cint(col), cint(row)
+
+    manifest = read_manifest(blood_smear_image)
+    if not manifest:
+        return Response(status=404, headers={"Cache-Control": "no-store"})
+
+    version = manifest["version"]
+    cache_control = CACHE_CONTROL if v == version else "private, no-cache"
+    etag = f'"{version}-{level}-{col}-{row}"'
+    if etag in frappe.request.headers.get("If-None-Match", ""):
+        return Response(status=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+    try:
+        with open(os.path.join(get_pyramid_folder(blood_smear_image), str(level), f"{col}_{row}.jpg"), "rb") as f:
+            content = f.read()
+    except FileNotFoundError:
+        return Response(status=404, headers={"Cache-Control": "no-store"})
+
+    return Response(content, content_type="image/jpeg", headers={"ETag": etag, "Cache-Control": cache_control})
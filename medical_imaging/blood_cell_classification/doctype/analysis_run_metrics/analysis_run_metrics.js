@@ -0,0 +1,8 @@
+// Copyright (c) 2026, algo-rhythm.tech and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on("Analysis Run Metrics", {
+// 	refresh(frm) {
+
+// 	},
+// });
@@ -19,10 +19,27 @@ class BloodCellAnalysisConfiguration(Document):
 		if not detection_model_path or not os.path.exists(detection_model_path):
 			frappe.throw(f"Detection model not found at {classification_model_path}. Please upload a valid model file.")
 
+		if self.detection_mode == "Tiled" and (self.detection_tile_overlap or 0) >= (self.detection_tile_size or 0):
+			frappe.throw("Tile Overlap must be smaller than Tile Size.")
+
 	def on_update(self):
 		frappe.clear_cache(doctype="Blood Cell Analysis Configuration")  # Clear doctype cache
 		frappe.db.commit()  # Commit to apply changes
 		frappe.logger().info("Cache Cleared: Blood Cell Analysis Configuration")
 
+		changed_models = [
+			name for name, fieldname in (("detector", "fasterrcnn_model_path"), ("classifier", "classification_model_path"))
+			if self.has_value_changed(fieldname) or self.has_value_changed("optimized_inference")
+		]
+		if changed_models:
+			from medical_imaging.api import model_registry
+
+			for name in changed_models:
+				model_registry.invalidate(name)
+			if "detector" in changed_models:
+				from medical_imaging.api import detection_cache
+
+				detection_cache.clear()
+
 def get_config():
 	return frappe.get_single("Blood Cell Analysis Configuration")
\ No newline at end of file
@@ -3,6 +3,10 @@
 
 frappe.ui.form.on('Blood Smear Image', {
     refresh: function(frm) {
+        if (frm.doc.image && !frm.is_new()) {
+            frm.smear_viewer = new medical_imaging.SmearViewer(frm.fields_dict.smear_viewer.$wrapper, frm.doc.name);
+            frm.smear_viewer.load();
+        }
 
         // Ensure the button is only shown when the document is in submitted state (docstatus = 1)
         if (frm.doc.docstatus === 1) {
@@ -10,28 +14,19 @@ frappe.ui.form.on('Blood Smear Image', {
                 .then(response => {
                     if (!response.message || !response.message.name) {
                         let button = frm.add_custom_button(__('Detect Cells'), function() {
-                            // Show infinite progress bar
-                            let progress_bar = frappe.show_progress(__('Detecting Cells...'), 80, 100);
-
+                            // Detection, extraction, classification and the report run as one background job
                             frappe.call({
-                                method: 'medical_imaging.api.cell_detection.detect_cells',
+                                method: 'medical_imaging.api.pipeline.enqueue_pipeline',
                                 args: {
                                     blood_smear_id: frm.doc.name
                                 },
                                 callback: function(response) {
-                                    // Hide progress bar
-                                    frappe.hide_progress();
-
-                                    if (response.message) {
-                                        let cell_detection_id = response.message.cell_detection_image;
-
-                                        // Show acknowledgment message before redirecting
-                                        frappe.msgprint(__('Cells Detected Successfully! Redirecting you to the results...'));
-
-                                        // Wait for 1.5 seconds before redirecting
-                                        setTimeout(() => {
-                                            frappe.set_route("Form", "Cell Detection Image", cell_detection_id);
-                                        }, 2000);
+                                    if (response.message && response.message.status === "queued") {
+                                        frappe.show_alert({
+                                            message: __('Analysis started in the background. You will be redirected once cells are detected.'),
+                                            indicator: 'blue'
+                                        }, 5);
+                                        listenForDetection(frm, response.message.pipeline_run);
                                         frappe.call({
                                             method: "frappe.model.workflow.apply_workflow",
                                             args: {
@@ -53,3 +48,23 @@ frappe.ui.form.on('Blood Smear Image', {
         }
     }
 });
+
+// Redirect to the Cell Detection Image as soon as the pipeline finishes its detection stage
+function listenForDetection(frm, pipeline_run) {
+    const handler = function(data) {
+        if (data.pipeline_run !== pipeline_run) {
+            return;
+        }
+        if (data.stage === "Detection" && data.status === "Completed") {
+            frappe.realtime.off("pipeline_progress", handler);
+            frappe.msgprint(__('Cells Detected Successfully! Redirecting you to the results...'));
+            setTimeout(() => {
+                frappe.set_route("Form", "Cell Detection Image", data.cell_detection_image);
+            }, 2000);
+        } else if (data.status === "Failed") {
+            frappe.realtime.off("pipeline_progress", handler);
+            frappe.msgprint(__('Cell Detection Failed!'));
+        }
+    };
+    frappe.realtime.on("pipeline_progress", handler);
+}
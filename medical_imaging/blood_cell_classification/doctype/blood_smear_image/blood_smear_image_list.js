@@ -0,0 +1,30 @@
+frappe.listview_settings["Blood Smear Image"] = {
+    onload(listview) {
+        // Detect every selected smear from one background job, batching them through the detector
+        listview.page.add_actions_menu_item(__('Detect Cells'), function() {
+            const names = listview.get_checked_items(true);
+            frappe.call({
+                method: "medical_imaging.api.cell_detection.detect_cells_batch",
+                args: { blood_smear_ids: names },
+                callback: function(r) {
+                    if (r.message && r.message.status === "queued") {
+                        frappe.show_alert({
+                            message: __('Detecting cells on {0} smears in the background', [r.message.images]),
+                            indicator: 'green'
+                        });
+                    } else {
+                        frappe.msgprint(r.message.message || __('Failed to queue batch detection.'));
+                    }
+                }
+            });
+        });
+
+        frappe.realtime.on("batch_detection_progress", function(data) {
+            frappe.show_progress(__('Detecting Cells'), data.done, data.total,
+                __('{0} of {1} smears', [data.done, data.total]), true);
+            if (data.done === data.total) {
+                listview.refresh();
+            }
+        });
+    },
+};
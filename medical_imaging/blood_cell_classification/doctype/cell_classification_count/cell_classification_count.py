@@ -0,0 +1,9 @@
+# Copyright (c) 2026, algo-rhythm.tech and contributors
+# For license information, please see license.txt
+
+# import frappe
+from frappe.model.document import Document
+
+
+class CellClassificationCount(Document):
+	pass
@@ -0,0 +1,40 @@
+# Copyright (c) 2026, algo-rhythm.tech and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from medical_imaging.api import aggregates
+from medical_imaging.patches.v1_0 import rebuild_cell_classification_counts
+
+
+class TestCellClassificationCount(FrappeTestCase):
+	def setUp(self):
+		self.cell_detection_image = frappe.get_doc({"doctype": "Cell Detection Image"}).insert().name
+		self.cells = [
+			frappe.get_doc({
+				"doctype": "Extracted Cell",
+				"cell_detection_image": self.cell_detection_image,
+				"primary_classification": "Circular",
+				"cell_number": i
+			}).insert()
+			for i in range(3)
+		]
+
+	def test_counts_follow_insert_and_reclassification(self):
+		self.cells[0].validated_classification = "Elongated"
+		self.cells[0].save()
+
+		counts = aggregates.get_class_counts(self.cell_detection_image)
+		self.assertEqual(counts, {"Circular": 2, "Elongated": 1})
+
+	def test_reclassification_of_cells_extracted_before_counts(self):
+		# Cells extracted before the counts were maintained have no rows at all
+		frappe.db.delete(aggregates.AGGREGATE_DOCTYPE, {"cell_detection_image": self.cell_detection_image})
+		rebuild_cell_classification_counts.execute()
+
+		self.cells[0].validated_classification = "Elongated"
+		self.cells[0].save()
+
+		counts = aggregates.get_class_counts(self.cell_detection_image)
+		self.assertEqual(counts, {"Circular": 2, "Elongated": 1})
+		self.assertEqual(aggregates.get_pair_counts(self.cell_detection_image), aggregates.count_pairs(self.cell_detection_image))
@@ -3,12 +3,40 @@
 
 frappe.ui.form.on("Cell Detection Image", {
     refresh: function(frm) {
+        buildDetectionResults(frm);
+        if (frm.doc.blood_smear_image) {
+            frm.smear_viewer = new medical_imaging.SmearViewer(frm.fields_dict.smear_viewer.$wrapper, frm.doc.blood_smear_image);
+            frm.smear_viewer.load().then(() => {
+                if (frm.smear_viewer.pyramid && (frm.doc.detections || (frm.doc.detection_result || []).length)) {
+                    const overlay = new medical_imaging.DetectionOverlay(frm.smear_viewer, frm.doc.name);
+                    overlay.make_filters();
+                    overlay.refresh();
+                }
+            });
+        }
         if (frm.doc.docstatus === 1) {
             setupButtons(frm);
         }
     }
 });
 
+// Detection Result rows are a view over the packed detections, built the first time the form is opened
+function buildDetectionResults(frm) {
+    if (!frm.doc.detections || (frm.doc.detection_result || []).length) {
+        return;
+    }
+
+    frappe.call({
+        method: "medical_imaging.api.detections.get_detection_results",
+        args: { cell_detection_image_id: frm.doc.name },
+        callback: function (response) {
+            if (response.message && response.message.rows) {
+                frm.reload_doc();
+            }
+        }
+    });
+}
+
 // Function to setup buttons based on extraction state
 function setupButtons(frm) {
     frappe.db.get_list("Extracted Cell", {
@@ -20,6 +48,7 @@ function setupButtons(frm) {
         if (extracted_count === 0) {
             // No extracted cells -> Show Extract Button
             addExtractButton(frm, extracted_count);
+            addRefilterButton(frm);
             return;
         }
 
@@ -76,6 +105,32 @@ function addGenerateReportButton(frm) {
 }
 
 
+// Re-apply the configured thresholds to the stored raw predictions, without running the detector
+function addRefilterButton(frm) {
+    if (!frm.doc.raw_predictions) {
+        return;
+    }
+
+    frm.add_custom_button(__('Re-filter Detections'), function () {
+        frappe.call({
+            method: "medical_imaging.api.cell_detection.refilter_detections",
+            args: { cell_detection_image_id: frm.doc.name },
+            freeze: true,
+            callback: function (response) {
+                if (response.message && response.message.status === "success") {
+                    frappe.show_alert({
+                        message: __('{0} detections kept with the current thresholds', [response.message.detections]),
+                        indicator: 'green'
+                    });
+                    frm.reload_doc();
+                } else {
+                    frappe.msgprint(__('Failed to re-filter detections: {0}', [response.message && response.message.message]));
+                }
+            }
+        });
+    });
+}
+
 // Function to add Extract Cells button (without grouping under Actions)
 function addExtractButton(frm, count) {
             if (count === 0) {
@@ -123,9 +178,14 @@ function addClassifyButton(frm, records) {
             args: { cell_detection_image_id: frm.doc.name },
             callback: function(response) {
                 if (response.message.status === "queued") {
-                    frappe.msgprint(__('Classification started in the background. Refresh to see updates.'));
+                    frappe.show_alert({
+                        message: __('Classification started in the background.'),
+                        indicator: 'blue'
+                    });
+                    watchClassificationProgress(frm);
                     // Start polling for job completion
                     frappe.realtime.on("classification_complete", function(data) {
+                    frappe.hide_progress();
                     frappe.msgprint(__('Classification completed. Navigating to Extracted Cells...'));
                     frappe.call({
                                 method: "frappe.model.workflow.apply_workflow",
@@ -148,6 +208,25 @@ function addClassifyButton(frm, records) {
     return true;
 }
 
+// Classification commits and reports every batch, so results show up while the job runs
+function watchClassificationProgress(frm) {
+    frappe.realtime.off("classification_progress");
+    frappe.realtime.on("classification_progress", function(data) {
+        if (data.cell_detection_image_id !== frm.doc.name) {
+            return;
+        }
+
+        const counts = Object.entries(data.class_counts || {})
+            .map(([classification, count]) => `${classification}: ${count}`)
+            .join(", ");
+        const title = data.stage === "xai" ? __('Rendering Grad-CAM Overlays') : __('Classifying Cells');
+        frappe.show_progress(title, data.done, data.total, __('{0} of {1} cells', [data.done, data.total]), true);
+        if (counts) {
+            frm.dashboard.set_headline(__('Classified so far: {0}', [counts]));
+        }
+    });
+}
+
 function navigateToExtractedCells(cell_detection_image_id) {
     // Navigate to the "Extracted Cell" doctype with a filter
     frappe.set_route('List', 'Extracted Cell', {
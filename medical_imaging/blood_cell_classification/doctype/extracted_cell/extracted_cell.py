@@ -3,7 +3,27 @@
 
 # import frappe
 from frappe.model.document import Document
+from medical_imaging.api import aggregates
 
 
 class ExtractedCell(Document):
-	pass
\ No newline at end of file
+	def after_insert(self):
+		aggregates.record_cells(self.cell_detection_image, [self])
+
+	def on_update(self):
+		"""Keep the Cell Classification Counts in step with single-document edits, e.g. a reviewer's validation."""
+		previous = self.get_doc_before_save()
+		if not previous:
+			return
+
+		if previous.cell_detection_image != self.cell_detection_image:
+			aggregates.record_cells(previous.cell_detection_image, [previous], sign=-1)
+			aggregates.record_cells(self.cell_detection_image, [self])
+		else:
+			aggregates.record_reclassification(self.cell_detection_image, [(
+				previous.primary_classification, previous.validated_classification,
+				self.primary_classification, self.validated_classification
+			)])
+
+	def on_trash(self):
+		aggregates.record_cells(self.cell_detection_image, [self], sign=-1)
\ No newline at end of file
@@ -1,5 +1,30 @@
 frappe.ui.form.on("RBC Morphology Analysis", {
     refresh(frm) {
+        if (!frm.is_new()) {
+            frm.add_custom_button(__('Download PDF'), function() {
+                window.open(frappe.urllib.get_full_url(
+                    "/api/method/medical_imaging.api.send_mail.download_report_pdf?docname="
+                    + encodeURIComponent(frm.doc.name)));
+            });
+        }
+
+        if (!frm.doc.approved_by && !frm.is_new()) {
+            // Counts come from maintained aggregates, so refreshing after a reclassification is cheap
+            frm.add_custom_button(__('Refresh Counts'), function() {
+                frappe.call({
+                    method: "medical_imaging.api.report.refresh_rbc_morphology_analysis",
+                    args: { rbc_morphology_analysis: frm.doc.name },
+                    callback: function(r) {
+                        if (r.message && r.message.status === "success") {
+                            frm.reload_doc();
+                        } else {
+                            frappe.msgprint(r.message.message || __('Failed to refresh counts.'));
+                        }
+                    }
+                });
+            });
+        }
+
         if (!frm.doc.approved_by) {
             frm.add_custom_button(__('Approve'), async function() {
                 const current_user = frappe.session.user;
@@ -3,8 +3,16 @@
 
 import frappe
 from frappe.model.document import Document
+from medical_imaging.api import pdf_cache
 
 
 class RBCMorphologyAnalysis(Document):
 	def before_save(self):
 		self.approved_by = frappe.get_value("User", self.approved_by_link, "full_name")
+
+	def on_update(self):
+		# Cached PDFs of earlier versions are never served again; free their space now
+		pdf_cache.invalidate(self.name)
+
+	def on_trash(self):
+		pdf_cache.invalidate(self.name)
@@ -0,0 +1,22 @@
+frappe.listview_settings["RBC Morphology Analysis"] = {
+    onload(listview) {
+        // Email every selected report from one background job instead of one blocking click each
+        listview.page.add_actions_menu_item(__('Email Reports'), function() {
+            const names = listview.get_checked_items(true);
+            frappe.call({
+                method: "medical_imaging.api.send_mail.enqueue_report_emails",
+                args: { names: names },
+                callback: function(r) {
+                    if (r.message && r.message.status === "queued") {
+                        frappe.show_alert({
+                            message: __('Emailing {0} reports in the background ({1})', [r.message.reports, r.message.report_email_dispatch]),
+                            indicator: 'green'
+                        });
+                    } else {
+                        frappe.msgprint(r.message.message || __('Failed to queue report emails.'));
+                    }
+                }
+            });
+        });
+    },
+};
@@ -2,6 +2,7 @@
 # For license information, please see license.txt
 import os
 import frappe
+from frappe.utils import get_bench_path
 
 # import frappe
 from frappe.model.document import Document
@@ -19,13 +20,95 @@ class BloodCellAnalysisConfiguration(Document):
 		if not detection_model_path or not os.path.exists(detection_model_path):
 			frappe.throw(f"Detection model not found at {classification_model_path}. Please upload a valid model file.")
 
+		if self.detection_mode == "Tiled" and (self.detection_tile_overlap or 0) >= (self.detection_tile_size or 0):
+			frappe.throw("Tile Overlap must be smaller than Tile Size.")
+
 	def on_update(self):
 		frappe.clear_cache(doctype="Blood Cell Analysis Configuration")  # Clear doctype cache
 		frappe.db.commit()  # Commit to apply changes
 		frappe.logger().info("Cache Cleared: Blood Cell Analysis Configuration")
 
+		changed_models = [
+			name for name, fieldname in (("detector", "fasterrcnn_model_path"), ("classifier", "classification_model_path"))
+			if self.has_value_changed(fieldname) or self.has_value_changed("optimized_inference")
+		]
+		if changed_models:
+			from medical_imaging.api import model_registry
+
+			for name in changed_models:
+				model_registry.invalidate(name)
+			if "detector" in changed_models:
+				from medical_imaging.api import detection_cache
+
+				detection_cache.clear()
+
 def get_detection_threshold_configuration():
 	return frappe.get_single("Blood Cell Analysis Configuration").detection_threshold
 
 def get_detection_average_area_tolerance():
-	return frappe.get_single("Blood Cell Analysis Configuration").detection_average_area_tolerance
\ No newline at end of file
+	return frappe.get_single("Blood Cell Analysis Configuration").detection_average_area_tolerance
+
+def get_classification_batch_size():
+	return frappe.get_single("Blood Cell Analysis Configuration").classification_batch_size or 32
+
+def get_classification_processes():
+	return frappe.get_single("Blood Cell Analysis Configuration").classification_processes or 1
+
+def get_generate_xai_on_classification():
+	return frappe.get_single("Blood Cell Analysis Configuration").generate_xai_on_classification
+
+def get_detection_tiling_configuration():
+	config = frappe.get_single("Blood Cell Analysis Configuration")
+	return frappe._dict(
+		mode=config.detection_mode or "Resize",
+		tile_size=config.detection_tile_size or 1000,
+		overlap=config.detection_tile_overlap or 0,
+		batch_size=config.detection_tile_batch_size or 4,
+	)
+
+def get_model_server_configuration():
+	config = frappe.get_single("Blood Cell Analysis Configuration")
+	return frappe._dict(
+		enabled=config.use_model_server,
+		socket_path=config.model_server_socket or os.path.join(get_bench_path(), "config", "medical_imaging_models.sock"),
+		max_batch_size=config.model_server_max_batch_size or 32,
+		max_detect_batch_size=config.model_server_max_detect_batch_size or 2,
+		batch_wait_ms=config.model_server_batch_wait_ms or 10,
+		timeout=config.model_server_timeout or 30,
+		detect_timeout=config.model_server_detect_timeout or 120,
+	)
+
+def get_inference_configuration():
+	config = frappe.get_single("Blood Cell Analysis Configuration")
+	return frappe._dict(
+		optimized=config.optimized_inference,
+		num_threads=config.torch_num_threads,
+		num_interop_threads=config.torch_num_interop_threads,
+	)
+
+def get_batch_detection_configuration():
+	config = frappe.get_single("Blood Cell Analysis Configuration")
+	return frappe._dict(
+		batch_size=config.detection_batch_size or 4,
+		decode_workers=config.detection_decode_workers or 4,
+	)
+
+def get_detection_cache_configuration():
+	config = frappe.get_single("Blood Cell Analysis Configuration")
+	return frappe._dict(
+		enabled=config.enable_detection_cache,
+		max_entries=config.detection_cache_size or 0,
+	)
+
+def get_report_email_configuration():
+	config = frappe.get_single("Blood Cell Analysis Configuration")
+	return frappe._dict(
+		render_workers=config.report_render_workers or 4,
+		batch_size=config.report_email_batch_size or 50,
+	)
+
+def get_pdf_cache_configuration():
+	size_mb = frappe.db.get_single_value("Blood Cell Analysis Configuration", "report_pdf_cache_size")
+	return frappe._dict(
+		max_bytes=(size_mb or 0) * 1024 * 1024,
+	)
\ No newline at end of file
@@ -3,9 +3,18 @@
 
 # import frappe
 from frappe.model.document import Document
+from medical_imaging.api import tiles
 
 
 class BloodSmearImage(Document):
 	def before_save(self):
 		from frappe.utils import now, getdate
 		self.capture_date = getdate(now())
+
+	def on_submit(self):
+		# Viewers only ever fetch tiles, so the pyramid is cut once, right after submission
+		if self.image:
+			tiles.enqueue_pyramid(self.name)
+
+	def on_trash(self):
+		tiles.clear_pyramid(self.name)
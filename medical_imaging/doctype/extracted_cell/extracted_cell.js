@@ -1,6 +1,21 @@
 // Copyright (c) 2025, algo-rhythm.tech and contributors
 // For license information, please see license.txt
 frappe.ui.form.on('Extracted Cell', {
+    refresh: function(frm) {
+        // Grad-CAM overlays are rendered lazily, the first time a classified cell is opened
+        if (!frm.is_new() && !frm.doc.xai_image
+            && frm.doc.validated_classification && frm.doc.validated_classification !== "Select") {
+            frappe.call({
+                method: "medical_imaging.api.explainability.get_xai_image",
+                args: { extracted_cell_id: frm.doc.name },
+                callback: function(response) {
+                    if (response.message && response.message.status === "success") {
+                        frm.reload_doc();
+                    }
+                }
+            });
+        }
+    },
     onload: function(frm) {
         if (frm.doc.original_image && frm.doc.xai_visualisation) {
             // Get the image URLs
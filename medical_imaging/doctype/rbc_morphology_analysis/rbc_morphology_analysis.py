@@ -3,7 +3,13 @@
 
 # import frappe
 from frappe.model.document import Document
+from medical_imaging.api import pdf_cache
 
 
 class RBCMorphologyAnalysis(Document):
-	pass
+	def on_update(self):
+		# Cached PDFs of earlier versions are never served again; free their space now
+		pdf_cache.invalidate(self.name)
+
+	def on_trash(self):
+		pdf_cache.invalidate(self.name)
@@ -0,0 +1,13 @@
+import frappe
+from medical_imaging.api import aggregates
+
+
+def execute():
+    # Cells extracted before the counts were maintained have no rows yet, and a later
+    # reclassification would otherwise only store its deltas for them
+    cell_detection_images = frappe.get_all("Extracted Cell",
+                                           filters={"cell_detection_image": ("is", "set")},
+                                           pluck="cell_detection_image",
+                                           distinct=True)
+    for cell_detection_image in cell_detection_images:
+        aggregates.rebuild(cell_detection_image)
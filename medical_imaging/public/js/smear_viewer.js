@@ -0,0 +1,240 @@
+frappe.provide("medical_imaging");
+
+// Deep-zoom viewer for a Blood Smear Image. Only the tiles covering the visible region at the
+// displayed zoom level are requested; their URLs are versioned so the browser caches them.
+medical_imaging.SmearViewer = class SmearViewer {
+    constructor(wrapper, blood_smear_image, options = {}) {
+        this.wrapper = $(wrapper);
+        this.blood_smear_image = blood_smear_image;
+        this.height = options.height || 480;
+        this.max_scale = options.max_scale || 4;
+        this.tiles = {};
+        this.layers = [];
+        // A form refresh creates a new viewer in the same wrapper; the old one stops polling
+        this.wrapper.data("smear_viewer", this);
+    }
+
+    // Resolves once the pyramid is loaded (or has failed), so callers can add layers after it
+    async load(attempt = 0) {
+        const r = await frappe.call({
+            method: "medical_imaging.api.tiles.get_pyramid",
+            args: { blood_smear_image: this.blood_smear_image }
+        });
+        if (this.wrapper.data("smear_viewer") !== this) {
+            return;
+        }
+        // The pyramid is built in the background on first view; poll until it is ready
+        if (r.message && r.message.status === "building") {
+            if (attempt < 60) {
+                this.wrapper.html(`<div class="text-muted">${__('Preparing smear tiles…')}</div>`);
+                await new Promise((resolve) => setTimeout(resolve, 2000));
+                return this.load(attempt + 1);
+            }
+            this.wrapper.html(`<div class="text-danger">${__('Smear tiles are taking too long to prepare. Please reload the form later.')}</div>`);
+            frappe.show_alert({ message: __('Smear tiles could not be prepared in time.'), indicator: "red" });
+            return;
+        }
+        if (!r.message || r.message.status !== "success") {
+            this.wrapper.html(`<div class="text-danger">${__('Smear tiles are not available.')}</div>`);
+            frappe.show_alert({ message: (r.message && r.message.message) || __('Smear tiles are not available.'), indicator: "red" });
+            return;
+        }
+
+        this.pyramid = r.message;
+        this.make();
+        this.fit();
+    }
+
+    make() {
+        this.wrapper.empty();
+        this.$viewport = $(`<div class="smear-viewer"></div>`).css({
+            position: "relative",
+            overflow: "hidden",
+            height: `${this.height}px`,
+            background: "var(--gray-900)",
+            cursor: "grab"
+        }).appendTo(this.wrapper);
+        this.$tiles = $(`<div></div>`).appendTo(this.$viewport);
+
+        this.$viewport.on("wheel", (e) => {
+            e.preventDefault();
+            const offset = this.$viewport.offset();
+            this.zoom_at(e.pageX - offset.left, e.pageY - offset.top, e.originalEvent.deltaY < 0 ? 1.25 : 0.8);
+        });
+        this.$viewport.on("dblclick", () => this.fit());
+
+        let drag = null;
+        this.$viewport.on("mousedown", (e) => {
+            drag = { x: e.pageX - this.x, y: e.pageY - this.y };
+            this.$viewport.css("cursor", "grabbing");
+        });
+        // Only the viewer of the current form tracks drags outside its viewport
+        $(document).off(".smear_viewer").on("mousemove.smear_viewer", (e) => {
+            if (drag) {
+                this.x = e.pageX - drag.x;
+                this.y = e.pageY - drag.y;
+                this.update();
+            }
+        });
+        $(document).on("mouseup.smear_viewer", () => {
+            drag = null;
+            this.$viewport.css("cursor", "grab");
+        });
+    }
+
+    fit() {
+        const width = this.$viewport.width();
+        this.min_scale = Math.min(width / this.pyramid.width, this.height / this.pyramid.height);
+        this.scale = this.min_scale;
+        this.x = (width - this.pyramid.width * this.scale) / 2;
+        this.y = (this.height - this.pyramid.height * this.scale) / 2;
+        this.update();
+    }
+
+    zoom_at(px, py, factor) {
+        const scale = Math.min(Math.max(this.scale * factor, this.min_scale), this.max_scale);
+        this.x = px - (px - this.x) * scale / this.scale;
+        this.y = py - (py - this.y) * scale / this.scale;
+        this.scale = scale;
+        this.update();
+    }
+
+    get_level() {
+        // Lowest level that still has at least one image pixel per screen pixel
+        const max_level = this.pyramid.levels - 1;
+        const level = max_level + Math.ceil(Math.log2(Math.min(this.scale, 1)));
+        return Math.max(0, Math.min(max_level, level));
+    }
+
+    tile_url(level, col, row) {
+        const args = new URLSearchParams({
+            blood_smear_image: this.blood_smear_image,
+            level: level,
+            col: col,
+            row: row,
+            v: this.pyramid.version
+        });
+        return `/api/method/medical_imaging.api.tiles.get_tile?${args}`;
+    }
+
+    update() {
+        const { width, height, tile_size, levels } = this.pyramid;
+        const level = this.get_level();
+        const level_scale = Math.pow(2, level - (levels - 1));
+        const level_width = Math.ceil(width * level_scale);
+        const level_height = Math.ceil(height * level_scale);
+
+        // Visible region in level pixels
+        const left = Math.max(0, -this.x / this.scale * level_scale);
+        const top = Math.max(0, -this.y / this.scale * level_scale);
+        const right = Math.min(level_width, (this.$viewport.width() - this.x) / this.scale * level_scale);
+        const bottom = Math.min(level_height, (this.height - this.y) / this.scale * level_scale);
+
+        const visible = {};
+        const screen_scale = this.scale / level_scale;
+        for (let row = Math.floor(top / tile_size); row * tile_size < bottom; row++) {
+            for (let col = Math.floor(left / tile_size); col * tile_size < right; col++) {
+                const key = `${level}/${col}/${row}`;
+                let $tile = this.tiles[key];
+                if (!$tile) {
+                    $tile = this.tiles[key] = $(`<img draggable="false">`)
+                        .attr("src", this.tile_url(level, col, row))
+                        .css({ position: "absolute", "pointer-events": "none" })
+                        .appendTo(this.$tiles);
+                }
+                $tile.css({
+                    left: `${this.x + col * tile_size * screen_scale}px`,
+                    top: `${this.y + row * tile_size * screen_scale}px`,
+                    width: `${Math.min(tile_size, level_width - col * tile_size) * screen_scale}px`,
+                    height: `${Math.min(tile_size, level_height - row * tile_size) * screen_scale}px`
+                });
+                visible[key] = true;
+            }
+        }
+
+        for (const key of Object.keys(this.tiles)) {
+            if (!visible[key]) {
+                this.tiles[key].remove();
+                delete this.tiles[key];
+            }
+        }
+
+        this.layers.forEach((layer) => layer.update(this));
+    }
+};
+
+// Detection boxes of a Cell Detection Image drawn as an SVG layer over a SmearViewer. Boxes
+// come from the stored arrays, filtered by class and score on the server; nothing is rasterized.
+medical_imaging.DetectionOverlay = class DetectionOverlay {
+    constructor(viewer, cell_detection_image) {
+        this.viewer = viewer;
+        this.cell_detection_image = cell_detection_image;
+        this.classes = ["Circular", "Elongated", "Other"];
+        this.min_score = null;
+        this.svg = document.createElementNS("http://www.w3.org/2000/svg", "svg");
+        $(this.svg).css({ position: "absolute", "pointer-events": "none", overflow: "visible" });
+        this.svg.setAttribute("preserveAspectRatio", "none");
+        viewer.layers.push(this);
+    }
+
+    make_filters() {
+        const $filters = $(`<div class="detection-overlay-filters flex align-center" style="gap: var(--padding-md); margin-bottom: var(--margin-sm);"></div>`)
+            .prependTo(this.viewer.wrapper);
+        this.classes.forEach((classification) => {
+            $(`<label class="flex align-center" style="gap: 4px; margin: 0;">
+                <input type="checkbox" checked> ${__(classification)}
+            </label>`).appendTo($filters).find("input").on("change", (e) => {
+                this.classes = e.target.checked
+                    ? this.classes.concat(classification)
+                    : this.classes.filter((c) => c !== classification);
+                this.refresh();
+            });
+        });
+        $(`<label class="flex align-center" style="gap: 4px; margin: 0;">
+            ${__('Min. Score (%)')} <input type="number" min="0" max="100" step="1" class="form-control input-xs" style="width: 80px;">
+        </label>`).appendTo($filters).find("input").on("change", (e) => {
+            this.min_score = e.target.value === "" ? null : e.target.value;
+            this.refresh();
+        });
+        this.$count = $(`<span class="text-muted"></span>`).appendTo($filters);
+    }
+
+    async refresh() {
+        const r = await frappe.call({
+            method: "medical_imaging.api.overlay.get_detection_overlay",
+            args: {
+                cell_detection_image_id: this.cell_detection_image,
+                classes: this.classes,
+                min_score: this.min_score
+            }
+        });
+        if (!r.message || r.message.status !== "success") {
+            return;
+        }
+
+        const { width, height, boxes, classes, scores, colors } = r.message;
+        this.svg.setAttribute("viewBox", `0 0 ${width} ${height}`);
+        this.svg.innerHTML = boxes.map(([x1, y1, x2, y2], i) =>
+            `<rect x="${x1}" y="${y1}" width="${x2 - x1}" height="${y2 - y1}" fill="none"
+                stroke="${colors[classes[i]]}" stroke-width="2" vector-effect="non-scaling-stroke">
+                <title>${__(classes[i])} ${(scores[i] * 100).toFixed(1)}%</title></rect>`
+        ).join("");
+        this.$count && this.$count.text(__('{0} detections', [boxes.length]));
+        this.update(this.viewer);
+    }
+
+    update(viewer) {
+        if (!viewer.$viewport) {
+            return;
+        }
+        if (this.svg.parentNode !== viewer.$viewport[0]) {
+            viewer.$viewport.append(this.svg);
+        }
+        $(this.svg).css({
+            left: `${viewer.x}px`,
+            top: `${viewer.y}px`,
+            width: `${viewer.pyramid.width * viewer.scale}px`,
+            height: `${viewer.pyramid.height * viewer.scale}px`
+        });
+    }
+};